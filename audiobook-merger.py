@@ -1,21 +1,111 @@
 #!/usr/bin/python3
 import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextlib
 import csv
+import ctypes
+import ctypes.util
+import errno
+from fractions import Fraction
+import hashlib
+import itertools
+import json
 import os
 from pathlib import Path
+import queue
 import re
+import select
 import shutil
+import signal
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 from tqdm import tqdm
 
-# todo: autodetect largest jpg or png in root folder as artwork
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where --profile leaves out the totals
+    resource = None
+
 # todo: command line --metadata k=v flag
 # todo: fix Windows "file still in use" bug
-# todo: fix unhelpful "broken pipe" issue when there is an error
 # todo: iff. all inputs have chapters, use those instead
 
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+DEFAULT_PREFETCH = 2
+DEFAULT_BUFFER_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_MEMORY = 1024 * 1024 * 1024
+DEFAULT_SEGMENT_CACHE_SIZE = 4 * 1024 * 1024 * 1024
+# the files in a directory given to --batch that are taken to be manifests
+BATCH_MANIFEST_EXTENSIONS = ('.csv', '.txt')
+# the files a directory given as input is merged from
+AUDIO_EXTENSIONS = {
+    '.aac', '.flac', '.m4a', '.m4b', '.mp3', '.ogg', '.opus', '.wav', '.wma',
+}
+ALBUM_ART_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+# the container and codec of an output, by its extension. Anything else is
+# an MP4 of AAC.
+OUTPUT_FORMATS = {
+    '.mp3': ('mp3', 'libmp3lame'),
+    '.ogg': ('ogg', 'libopus'),
+    '.opus': ('ogg', 'libopus'),
+}
+# the containers album art can be added to
+ALBUM_ART_FORMATS = {'mp4', 'mp3'}
+# how many chunks of audio an encoder fed alongside others can fall behind
+FAN_OUT_CHUNKS = 4
+# used to guess how long a file is before it has been analyzed
+ESTIMATED_BIT_RATE = 64000
+DEFAULT_SETTLE_TIME = 10
+DEFAULT_POLL_INTERVAL = 5
+# how many of the latest books --watch lists in its status
+WATCH_RECENT_BOOKS = 20
+# inotify events, from <sys/inotify.h>
+INOTIFY_MOVED_FROM = 0x40
+INOTIFY_MOVED_TO = 0x80
+INOTIFY_CLOSE_WRITE = 0x8
+INOTIFY_CREATE = 0x100
+INOTIFY_DELETE = 0x200
+INOTIFY_Q_OVERFLOW = 0x4000
+INOTIFY_ISDIR = 0x40000000
+PCM_CHUNK_SIZE = 1024 * 1024
+CHECKSUM_READ_SIZE = 4 * 1024 * 1024
+COPY_BLOCK_SIZE = 4 * 1024 * 1024
+# the file descriptors an ffmpeg needs besides one per input: stdio, the
+# metadata file, the art, the output and whatever its libraries open
+CONCAT_SPARE_FILES = 32
+# how far --verify lets a merged file's length be from the audio that went
+# into it, in samples: the encoder pads out its last frame
+VERIFY_TOLERANCE = 2048
+# the audio stream is copied as ADTS when it doesn't need re-encoding
+STREAM_COPY_ARGS = ('-map', '0:a:0', '-acodec', 'copy')
+AAC_FRAME_SIZE = 1024
+# frames of audio from before a shard that its encoder sees but doesn't keep
+SHARD_PREROLL_FRAMES = 3
+# bump this when the way chapter segments are encoded changes
+SEGMENT_VERSION = 1
+# bump this when the way shards are encoded for --resume changes
+JOURNAL_VERSION = 1
+# how long a process can go without showing any activity before it's
+# taken to have stalled, in seconds
+DEFAULT_STALL_TIMEOUT = 300
+# how often processes are checked for stalls, in seconds
+SUPERVISOR_INTERVAL = 1
+# how much of each process's stderr is kept for error messages
+STDERR_TAIL_SIZE = 64 * 1024
+# the most often --progress-format jsonl reports on a stage, in seconds
+PROGRESS_INTERVAL = 0.5
+# shows audio seconds rather than a count, so the rate is x realtime
+SECONDS_BAR_FORMAT = \
+    '{l_bar}{bar}| {n:.0f}/{total:.0f}s ' \
+    '[{elapsed}<{remaining}, {rate_noinv_fmt}{postfix}]'
+
+
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
@@ -28,29 +118,456 @@ def delete_temporary_file(file_name):
         eprint(f'Warning: couldn\'t remove temporary file "{file_name}": {e2}')
 
 
-def run_stream(args, capture_stdout=True, capture_stderr=True):
-    stdin_stream = subprocess.PIPE if input is not None else None
-    stdout_stream = subprocess.PIPE if capture_stdout else None
-    stderr_stream = subprocess.PIPE if capture_stderr else None
-    return subprocess.Popen(
-        args, stdin=stdin_stream, stdout=stdout_stream, stderr=stderr_stream
-    )
+# Collects the time spent in each stage of a merge, and the lifetime of each
+# process it runs, for --profile. Does nothing unless enabled.
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._start_time = time.monotonic()
+        # name -> [count, wall seconds, cpu seconds]
+        self._stages = {}
+        self._processes = []
+        self._audio_seconds = 0
+
+    def enable(self):
+        self.enabled = True
+        self._start_time = time.monotonic()
+
+    # adds to a stage's totals; cpu is the time of the thread it ran on
+    def add(self, name, wall, cpu=0):
+        with self._lock:
+            totals = self._stages.setdefault(name, [0, 0, 0])
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += cpu
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(name,
+                     time.perf_counter() - start_wall,
+                     time.thread_time() - start_cpu)
+
+    def add_audio(self, seconds):
+        with self._lock:
+            self._audio_seconds += seconds
+
+    def process_started(self, process, args, spawn_seconds):
+        # the input file is the most useful thing to know about a process
+        inputs = [args[i + 1] for i, arg in enumerate(args[:-1]) if arg == '-i']
+        record = {
+            'program': os.path.basename(args[0]),
+            'input': inputs[0] if inputs else None,
+            'pid': process.pid,
+            'started': time.monotonic() - self._start_time,
+            'spawn_seconds': spawn_seconds,
+            'lifetime_seconds': None,
+            'returncode': None,
+        }
+        with self._lock:
+            self._processes.append(record)
+        return record
+
+    def report(self):
+        wall = time.monotonic() - self._start_time
+        report = {
+            'wall_seconds': wall,
+            'audio_seconds': self._audio_seconds,
+            'realtime_factor': self._audio_seconds / max(wall, 1e-6),
+            'stages': {
+                name: {'count': count, 'wall_seconds': w, 'cpu_seconds': c}
+                for name, (count, w, c) in sorted(
+                    self._stages.items(), key=lambda x: -x[1][1])
+            },
+            'processes': self._processes,
+        }
+        if resource:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            report['cpu_seconds'] = usage.ru_utime + usage.ru_stime
+            report['children_cpu_seconds'] = \
+                children.ru_utime + children.ru_stime
+        return report
+
+    def write_report(self, report_filename):
+        report = self.report()
+        with open(report_filename, 'w', encoding='utf-8') as report_file:
+            json.dump(report, report_file, indent=2)
+
+        eprint(f'{"stage":<24} {"count":>7} {"wall":>10} {"cpu":>10}')
+        for name, stage in report['stages'].items():
+            eprint(f'{name:<24} {stage["count"]:>7} '
+                   f'{stage["wall_seconds"]:>9.3f}s '
+                   f'{stage["cpu_seconds"]:>9.3f}s')
+
+        programs = {}
+        for process in report['processes']:
+            programs.setdefault(process['program'], []).append(process)
+        for program, processes in sorted(programs.items()):
+            lifetimes = [p['lifetime_seconds'] or 0 for p in processes]
+            spawn = sum(p['spawn_seconds'] for p in processes)
+            eprint(f'{len(processes)} {program} processes: '
+                   f'{sum(lifetimes):.3f}s alive in total, '
+                   f'{max(lifetimes):.3f}s longest, '
+                   f'{spawn / len(processes) * 1000:.1f}ms to spawn on average')
+
+        if 'cpu_seconds' in report:
+            eprint(f'CPU: {report["cpu_seconds"]:.3f}s in this process, '
+                   f'{report["children_cpu_seconds"]:.3f}s in ffmpeg')
+        eprint(f'{report["audio_seconds"]:.1f}s of audio in '
+               f'{report["wall_seconds"]:.3f}s '
+               f'({report["realtime_factor"]:.1f}x realtime)')
+
+
+profiler = Profiler()
+
+
+# Writes progress events as JSON lines, for --progress-format jsonl
+class ProgressEvents:
+    def __init__(self):
+        self._file = None
+        self._lock = threading.Lock()
+        # the book being merged on each thread, with --batch
+        self.context = threading.local()
+
+    @property
+    def enabled(self):
+        return self._file is not None
+
+    def open(self, fd):
+        self._file = os.fdopen(fd, 'w', encoding='utf-8', closefd=False)
+
+    def emit(self, event):
+        line = json.dumps(event) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+
+progress_events = ProgressEvents()
+
+
+# Reports a stage's progress as events, in place of a tqdm bar
+class JsonlProgress:
+    def __init__(self, stage, total=None, desc=None, unit='file'):
+        self.stage = stage
+        self.total = total
+        self.n = 0
+        self.unit = unit
+        self._file = None
+        self._book = getattr(progress_events.context, 'book', None)
+        self._start_time = time.monotonic()
+        self._last_emit = None
+        self._emit('start')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _emit(self, event):
+        self._last_emit = time.monotonic()
+        elapsed = self._last_emit - self._start_time
+        rate = self.n / elapsed if elapsed > 0 else None
+        eta = (self.total - self.n) / rate \
+            if rate and self.total is not None else None
+        progress_events.emit({
+            'event': event,
+            'time': time.time(),
+            'book': self._book,
+            'stage': self.stage,
+            'file': self._file,
+            'unit': self.unit,
+            'done': self.n,
+            'total': self.total,
+            'rate': rate,
+            'eta': max(eta, 0) if eta is not None else None,
+        })
+
+    def update(self, n=1):
+        self.n += n
+        if time.monotonic() - self._last_emit >= PROGRESS_INTERVAL:
+            self._emit('progress')
+
+    def set_file(self, verb, file_name):
+        self._file = file_name
+        self._emit('progress')
+
+    def set_postfix_str(self, s='', refresh=True):
+        pass
+
+    def close(self):
+        if self._last_emit is not None:
+            self._emit('end')
+            self._last_emit = None
+
+
+class ProgressBar(tqdm):
+    def set_file(self, verb, file_name):
+        self.set_description_str(f'{verb} {file_name}')
+
+
+# Shows the progress of a stage, as a bar or as events. The unit is 's' for
+# stages measured in seconds of audio.
+def progress_bar(stage, total=None, desc=None, unit='file'):
+    if progress_events.enabled:
+        return JsonlProgress(stage, total, desc, unit)
+    if unit == 's' and total is not None:
+        return ProgressBar(total=total, desc=desc or stage.capitalize(),
+                           unit=unit, bar_format=SECONDS_BAR_FORMAT)
+    return ProgressBar(total=total, desc=desc, unit=unit)
+
+
+# A process that records its lifetime with the profiler
+class _ProfiledPopen(subprocess.Popen):
+    def __init__(self, args, **kwargs):
+        start_time = time.monotonic()
+        super().__init__(args, **kwargs)
+        self._profile = profiler.process_started(
+            self, args, time.monotonic() - start_time)
+        self._profile_start = start_time
+
+    def _record_exit(self):
+        if self.returncode is not None and \
+                self._profile['lifetime_seconds'] is None:
+            self._profile['lifetime_seconds'] = \
+                time.monotonic() - self._profile_start
+            self._profile['returncode'] = self.returncode
+
+    def poll(self):
+        result = super().poll()
+        self._record_exit()
+        return result
+
+    def wait(self, timeout=None):
+        result = super().wait(timeout)
+        self._record_exit()
+        return result
+
+
+# Keeps the last max_size bytes written to it
+class RingBuffer:
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._chunks = collections.deque()
+        self._size = 0
+        self.dropped = 0
+
+    def append(self, data):
+        self._chunks.append(data)
+        self._size += len(data)
+        while self._size - len(self._chunks[0]) >= self._max_size:
+            dropped = self._chunks.popleft()
+            self._size -= len(dropped)
+            self.dropped += len(dropped)
+
+    def getvalue(self):
+        data = b''.join(self._chunks)[-self._max_size:]
+        if self.dropped or self._size > self._max_size:
+            data = b'[...]\n' + data
+        return data
+
+
+def _format_cmdline(args):
+    return ' '.join([f"'{a}'" for a in args])
+
+
+# A process started by a ProcessGroup. Its stderr is read as it's written so
+# the process can never block on it, and the end of it is kept for errors.
+class SupervisedProcess:
+    def __init__(
+        self,
+        args,
+        group,
+        pipe_stdin=False,
+        capture_stdout=True,
+        capture_stderr=True,
+        watch=True
+    ):
+        self.args = args
+        self._group = group
+        self._killed = False
+        self._stderr_tail = RingBuffer(STDERR_TAIL_SIZE)
+        # whether it counts as stalled if it shows no activity for a while
+        self.watched = watch
+        self.last_activity = time.monotonic()
+
+        popen = _ProfiledPopen if profiler.enabled else subprocess.Popen
+        self._popen = popen(
+            args,
+            stdin=subprocess.PIPE if pipe_stdin else subprocess.DEVNULL,
+            stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL,
+            stderr=subprocess.PIPE if capture_stderr else None)
+        self.stdin = self._popen.stdin
+        self.stdout = self._popen.stdout
+        self.pid = self._popen.pid
+
+        # stderr is only ever read here, not by communicate()
+        self._stderr = self._popen.stderr
+        self._popen.stderr = None
+        self._drainer = None
+        if capture_stderr:
+            self._drainer = threading.Thread(target=self._drain, daemon=True)
+            self._drainer.start()
+
+    def _drain(self):
+        stderr = self._stderr
+        try:
+            while data := os.read(stderr.fileno(), 64 * 1024):
+                self._stderr_tail.append(data)
+                self.touch()
+        finally:
+            stderr.close()
+        # a process that fails by itself takes its group down with it
+        if self._popen.wait() and not self._killed:
+            self._group.fail(self.error())
+
+    @property
+    def returncode(self):
+        return self._popen.returncode
+
+    # notes that the process is making progress
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+    def poll(self):
+        return self._popen.poll()
+
+    def wait(self, timeout=None):
+        return self._popen.wait(timeout)
+
+    # sends input and reads stdout until the process exits
+    def communicate(self, input=None):
+        out, _ = self._popen.communicate(input)
+        return out, self._stderr_tail.getvalue() if self._drainer else None
+
+    # stops the process, which isn't treated as a failure
+    def kill(self):
+        self._killed = True
+        if self._popen.poll() is None:
+            self._popen.kill()
+
+    # what the process has written to stderr. That's all of it once it has
+    # exited, but only what has been read so far if it's still running.
+    def error_output(self):
+        if self._drainer and self.poll() is not None and \
+                self._drainer is not threading.current_thread():
+            self._drainer.join()
+        return bytes.decode(self._stderr_tail.getvalue(), errors='replace')
+
+    def error(self, message='ffmpeg error'):
+        return RuntimeError(f'{message}:\n'
+                            f'Command line: {_format_cmdline(self.args)}\n'
+                            f'{self.error_output()}')
+
+
+# The processes working together on one job. The first of them to fail, or
+# stall, stops the rest, and its error is the one that's reported.
+class ProcessGroup:
+    def __init__(self):
+        self._processes = []
+        self._lock = threading.Lock()
+        self.failure = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.kill_all()
+
+    def start(self, args, **kwargs):
+        process = SupervisedProcess(args, self, **kwargs)
+        with self._lock:
+            self._processes.append(process)
+        supervisor.add(process)
+        return process
+
+    def fail(self, error):
+        with self._lock:
+            if self.failure is None:
+                self.failure = error
+        self.kill_all()
+
+    # the error to raise for the group: the first failure if there was one,
+    # or error if not
+    def first_failure(self, error):
+        return self.failure or error
+
+    def kill_all(self):
+        with self._lock:
+            processes = list(self._processes)
+        for process in processes:
+            process.kill()
+
+
+# Watches every running process, and fails the group of any that's shown no
+# activity for stall_timeout seconds
+class Supervisor:
+    def __init__(self):
+        self.stall_timeout = DEFAULT_STALL_TIMEOUT
+        self._processes = set()
+        self._lock = threading.Lock()
+        self._watchdog = None
+
+    def add(self, process):
+        with self._lock:
+            self._processes.add(process)
+            if not self._watchdog:
+                self._watchdog = threading.Thread(
+                    target=self._watch, daemon=True)
+                self._watchdog.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(SUPERVISOR_INTERVAL)
+            now = time.monotonic()
+            with self._lock:
+                self._processes = {
+                    p for p in self._processes if p.poll() is None}
+                stalled = [
+                    p for p in self._processes
+                    if self.stall_timeout and p.watched and
+                    now - p.last_activity > self.stall_timeout
+                ]
+            for process in stalled:
+                process._group.fail(process.error(
+                    f'{os.path.basename(process.args[0])} made no progress '
+                    f'for {self.stall_timeout:g}s'))
+
+
+supervisor = Supervisor()
+
+
+# Starts a process in a group of its own
+def start_process(args, **kwargs):
+    return ProcessGroup().start(args, **kwargs)
 
 
 def run_custom(
     args,
     capture_stdout=True,
     capture_stderr=True,
-    input=None
+    input=None,
+    watch=True
 ):
-    process = run_stream(args, capture_stdout, capture_stderr)
+    process = start_process(
+        args,
+        pipe_stdin=input is not None,
+        capture_stdout=capture_stdout,
+        capture_stderr=capture_stderr,
+        watch=watch)
     out, err = process.communicate(input)
-    retcode = process.poll()
-    if retcode:
-        cmdline_str = ' '.join([f"'{a}'" for a in args])
-        raise RuntimeError(f'ffmpeg error:\n'
-                           f'Command line: {cmdline_str}\n'
-                           f'{bytes.decode(err)}')
+    if process.returncode:
+        raise process.error()
     return out, err
 
 
@@ -69,12 +586,44 @@ class ParseException(Exception):
         return(f'{self.file_name}({self.line}): {self.message}')
 
 
+# A chapter of a manifest, and the files it's made of in order. There can be
+# tens of thousands of these, so they're kept small.
+class Chapter:
+    __slots__ = ('name', 'files')
+
+    def __init__(self, name, files=None):
+        self.name = name
+        self.files = files or []
+
+
 class Manifest:
     def __init__(self):
         self.key_value_pairs = {}
         self.album_art = None
-        self.files = []
         self.chapters = []
+        # the chapters by name, so that files can be added to them in
+        # constant time however many there are
+        self._chapters_by_name = {}
+
+    @property
+    def files(self):
+        return [file for chapter in self.chapters for file in chapter.files]
+
+    # adds a file to the end of the named chapter, or of a new chapter if
+    # there isn't one with that name yet
+    def add_file(self, chapter_name, file):
+        chapter = self._chapters_by_name.get(chapter_name)
+        if chapter is None:
+            chapter = Chapter(chapter_name)
+            self._chapters_by_name[chapter_name] = chapter
+            self.chapters.append(chapter)
+        chapter.files.append(file)
+
+    # adds a chapter to the end, even if there's already one with its name
+    def add_chapter(self, chapter_name, files):
+        chapter = Chapter(chapter_name, list(files))
+        self._chapters_by_name[chapter_name] = chapter
+        self.chapters.append(chapter)
 
 
 class ManifestParser:
@@ -160,23 +709,10 @@ class ManifestParser:
                 self._manifest.key_value_pairs[key] = value
 
     def _parse_chapter(self, file, chapter):
-        # find or append the chapter
-        chapter_matches = [x for x in \
-                            self._manifest.chapters if x['name'] == chapter]
-        if len(chapter_matches) > 0:
-            c = chapter_matches[-1]
-        else:
-            c = {
-                'name': chapter,
-                'files': files
-            }
-            self._manifest.chapters.append(c)
-
-        # accumulate a list of files
-        files = c['files']
+        # accumulate the files onto the chapter, which is only created once it
+        # has a file
         while line := self._parse_get_line(file):
-            files.append(line)
-            self._manifest.files.append(line)
+            self._manifest.add_file(chapter, line)
 
 
 class CsvParser:
@@ -185,57 +721,118 @@ class CsvParser:
         self._parse_line_number = 0
 
         with open(input_filename, 'r', newline='', encoding='utf-8') as input_file:
-            chapters = self._parse(input_file)
-
-        # Merge chapters and files into the manifest
-        for c in chapters:
-            chapter_matches = [x for x in \
-                               manifest.chapters if x['name'] == c['name']]
-            if len(chapter_matches) == 0:
-                manifest.chapters.append(c)
-            else:
-                chapter_matches[-1]['files'].extend(c['files'])
+            self._parse(input_file, manifest)
+
+    def _parse_exception(self, message):
+        raise ParseException(
+            message,
+            self._parse_file_name,
+            self._parse_line_number)
 
-            manifest.files.extend(c['files'])
+    # adds each row's file to its chapter as it's read
+    def _parse(self, input_file, manifest):
+        reader = csv.reader(input_file, delimiter=',', quotechar='"')
+        try:
+            for row in reader:
+                # a quoted field can span lines, so this is the row's last line
+                self._parse_line_number = reader.line_num
+                if len(row) > 1 and row[0]:
+                    manifest.add_file(row[1], row[0])
+                elif len(row) > 0:
+                    self._parse_exception(
+                        f"Expected <filename>,<chapter>: '{row}'")
+        except csv.Error as e:
+            self._parse_line_number = reader.line_num
+            self._parse_exception(str(e))
 
-    def _parse(self, input_file):
-        # ordered chapter names
-        chapter_names = []
-        # map of file lists for each chapter
-        chapter_map = {}
 
-        def add_file(file, chap):
-            if not chap in chapter_map:
-                chapter_names.append(chap)
-                chapter_map[chap] = []
+# sorts "Track 2" before "Track 10"
+def natural_sort_key(name):
+    return [int(token) if token.isdigit() else token.casefold()
+            for token in re.split(r'(\d+)', name)]
 
-            # Add tuple of name and duration
-            chapter_map[chap].append(file)
 
-        # Read the CSV file
-        reader = csv.reader(input_file, delimiter=',', quotechar='"')
-        self._parse_line_number = 0
-        for row in reader:
-            self._parse_line_number += 1
-            if len(row) > 1:
-                add_file(row[0], row[1])
-            elif len(row) > 0:
-                raise ParseException(
-                    f"Expected <filename>,<chapter>: '{row}'",
-                    self._parse_file_name,
-                    self._parse_line_number)
-
-        # flattens all files in unordered chapters into ordered chapters
-        def flatten_chapters(chapter_names, chapter_map):
-            sorted_chapters = []
-            for name in chapter_names:
-                sorted_chapters.append({
-                    'name': name,
-                    'files': chapter_map[name]
-                    })
-            return sorted_chapters
-
-        return flatten_chapters(chapter_names, chapter_map)
+# Lists the audio files, subdirectories and pictures in a directory. Only
+# what the directory listing says is used, so nothing is stat'ed except
+# symlinks, and pictures once it's known they're wanted.
+def _list_directory(path):
+    audio_files, subdirs, pictures = [], [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            # skip hidden files, like the ._ files macOS leaves on shares
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+                continue
+            extension = os.path.splitext(entry.name)[1].lower()
+            if extension in AUDIO_EXTENSIONS and entry.is_file():
+                audio_files.append(entry.path)
+            elif extension in ALBUM_ART_EXTENSIONS and entry.is_file():
+                pictures.append(entry)
+    by_name = lambda path: natural_sort_key(os.path.basename(path))
+    audio_files.sort(key=by_name)
+    subdirs.sort(key=by_name)
+    return audio_files, subdirs, pictures
+
+
+# Builds a manifest from a directory of audio files, in place of a manifest
+# file. Each subdirectory with audio in it is a chapter, named after it, of
+# all the audio in it in order. Audio files at the top are chapters named
+# after their title tags if they have one, and their file names if not. The
+# largest picture at the top is the album art.
+class DirectoryScanner:
+    def __init__(self, path, manifest, cache=None, jobs=None):
+        self._cache = cache
+        self._jobs = jobs
+
+        # the directories are listed concurrently a level at a time, as
+        # each listing can take a while on a network share
+        listings = {}
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            level = [path]
+            while level:
+                for dir_path, listing in zip(
+                        level, executor.map(_list_directory, level)):
+                    listings[dir_path] = listing
+                level = [subdir for dir_path in level
+                         for subdir in listings[dir_path][1]]
+
+        # files next to each other with the same title are one chapter, but
+        # the same title further on starts another, to keep the files in order
+        audio_files, subdirs, pictures = listings[path]
+        for name, group in itertools.groupby(
+                zip(audio_files, self._titles(audio_files)),
+                key=lambda file_title: file_title[1]):
+            manifest.add_chapter(name, (file_name for file_name, _ in group))
+        for subdir in subdirs:
+            files = list(self._tree_files(listings, subdir))
+            if files:
+                manifest.add_chapter(os.path.basename(subdir), files)
+
+        if pictures and not manifest.album_art:
+            manifest.album_art = max(
+                pictures, key=lambda entry: entry.stat().st_size).path
+
+    def _tree_files(self, listings, path):
+        audio_files, subdirs, _ = listings[path]
+        yield from audio_files
+        for subdir in subdirs:
+            yield from self._tree_files(listings, subdir)
+
+    # the title tag of each file, or its name if it hasn't got one. The files
+    # are probed concurrently, and the probes are cached for the merge.
+    def _titles(self, file_names):
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            infos = executor.map(
+                lambda file_name: probe_file(file_name, self._cache),
+                file_names)
+            titles = []
+            for file_name, info in zip(file_names, infos):
+                tags = {key.lower(): value for key, value in info.tags.items()}
+                titles.append(tags.get('title', '').strip() or
+                              Path(file_name).stem)
+        return titles
 
 
 def _file_stream_index(file_index, stream_index):
@@ -320,41 +917,296 @@ class FFmpegCommandLine:
         return cl
 
 
+# An output to write: where to, and how to encode it
+class OutputSpec:
+    def __init__(self, file_name, codec=None, bit_rate=None):
+        self.file_name = file_name
+        self.format, default_codec = OUTPUT_FORMATS.get(
+            Path(file_name).suffix.lower(), ('mp4', 'aac'))
+        self.codec = codec or default_codec
+        self.bit_rate = bit_rate
+
+    # parses FILE[,codec=CODEC][,bitrate=RATE]
+    @staticmethod
+    def parse(spec):
+        file_name, *options = spec.split(',')
+        settings = {}
+        for option in options:
+            key, _, value = option.partition('=')
+            if key not in ('codec', 'bitrate') or not value:
+                raise RuntimeError(f'Expected FILE[,codec=CODEC]'
+                                   f'[,bitrate=RATE] rather than "{spec}"')
+            settings[key] = value
+        if not file_name:
+            raise RuntimeError(f'Expected a file name in "{spec}"')
+        return OutputSpec(
+            os.path.abspath(file_name),
+            settings.get('codec'),
+            settings.get('bitrate'))
+
+    def encode_args(self):
+        args = ['-acodec', self.codec]
+        if self.bit_rate:
+            args.extend(['-b:a', self.bit_rate])
+        return args
+
+
+# Where temporary files are written: beside the files they're for, or in
+# --scratch-dir, to keep the work of a merge off slow (e.g. network) storage
+# until the result is moved into place
+class ScratchSpace:
+    def __init__(self):
+        self.dir = None
+        self._fallocate = None
+
+    def dir_for(self, file_name):
+        return self.dir or str(Path(file_name).parent)
+
+    # Reserves the space for a file about to be written, where the file
+    # system can do that without writing it out (unlike posix_fallocate,
+    # which falls back to writing zeros). Returns whether it could.
+    def preallocate(self, fd, size):
+        if self._fallocate is None:
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                   use_errno=True)
+                self._fallocate = libc.fallocate
+                self._fallocate.argtypes = [
+                    ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                    ctypes.c_int64]
+            except (AttributeError, OSError, TypeError):
+                self._fallocate = False
+        return bool(self._fallocate) and self._fallocate(fd, 0, 0, size) == 0
+
+    # Moves a finished temporary file over the output. That's a rename if
+    # they're on the same device. Otherwise it's one sequential copy to a
+    # temporary file beside the output, which then replaces it, so a
+    # partly copied output is never left in its place.
+    def commit(self, temp_filename, output_filename):
+        try:
+            os.replace(temp_filename, output_filename)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+        path_parts = Path(output_filename)
+        fd, copy_filename = tempfile.mkstemp(
+            dir=path_parts.parent,
+            prefix=path_parts.stem,
+            suffix=f'.tmp{path_parts.suffix}')
+        try:
+            with profiler.stage('copy output'), \
+                    open(temp_filename, 'rb') as source_file, \
+                    os.fdopen(fd, 'wb') as copy_file:
+                self.preallocate(
+                    copy_file.fileno(), os.fstat(source_file.fileno()).st_size)
+                shutil.copyfileobj(source_file, copy_file, COPY_BLOCK_SIZE)
+                copy_file.flush()
+                os.fsync(copy_file.fileno())
+            os.replace(copy_filename, output_filename)
+        except BaseException:
+            delete_temporary_file(copy_filename)
+            raise
+        delete_temporary_file(temp_filename)
+
+
+scratch = ScratchSpace()
+
+
 def make_temporary_filename(base_filename, new_extension=None):
     path_parts = Path(base_filename)
     if not new_extension:
         new_extension = path_parts.suffix
     return tempfile.mkstemp(
-        dir=path_parts.parent,
+        dir=scratch.dir_for(base_filename),
         prefix=path_parts.stem,
         suffix=f'.tmp{new_extension}')
 
 
-def get_file_metadata(file_name):
-    cmd = FFmpegCommandLine(
-        output_file='-',
-        overwrite=True,
-        format='ffmetadata')
-    cmd.add_file(file_name)
+class ProbeCache:
+    def __init__(self, cache_dir, max_size=DEFAULT_CACHE_SIZE):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
 
-    input_data, _ = run_custom(cmd.get_cmdline())
+    # entries are only valid for the exact file contents they were probed
+    # from, so the key includes the size and modification time
+    def _entry_filename(self, file_name):
+        file_name = os.path.abspath(file_name)
+        st = os.stat(file_name)
+        key = f'{file_name}\0{st.st_size}\0{st.st_mtime_ns}'
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self._cache_dir, f'{digest}.json')
 
-    metadata = {}
+    def get(self, file_name):
+        entry_filename = self._entry_filename(file_name)
+        try:
+            with open(entry_filename, 'r', encoding='utf-8') as entry_file:
+                record = json.load(entry_file)
+            # mark the entry as recently used
+            os.utime(entry_filename)
+            return record
+        except (OSError, ValueError):
+            return None
 
-    lines = input_data.decode("utf-8").split('\n')
+    def update(self, file_name, values):
+        entry_filename = self._entry_filename(file_name)
+        record = self.get(file_name) or {}
+        record.update(values)
 
-    if len(lines) == 0:
-        return metadata
+        # write to a temporary file first so readers never see partial entries
+        fd, temp_filename = tempfile.mkstemp(
+            dir=self._cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as entry_file:
+                json.dump(record, entry_file)
+            os.replace(temp_filename, entry_filename)
+        except Exception as e:
+            delete_temporary_file(temp_filename)
+            raise e
 
-    if lines[0] != ';FFMETADATA1':
-        raise RuntimeError(f'Unknown metadata format: "{lines[0]}"')
+    # evicts the least recently used entries until the cache fits
+    def prune(self):
+        entries = []
+        total_size = 0
+        with os.scandir(self._cache_dir) as it:
+            for entry in it:
+                if not entry.name.endswith('.json'):
+                    continue
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total_size += st.st_size
 
-    # Convert to key value pairs
-    for line in lines[1:]:
-        key, value = [x.strip() for x in line.partition('=')[::2]]
-        metadata[key] = value
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self._max_size:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError as e:
+                eprint(f'Warning: couldn\'t evict cache entry "{path}": {e}')
 
-    return metadata
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.environ.get('LOCALAPPDATA') or \
+        os.path.join(Path.home(), '.cache')
+    return os.path.join(base, 'audiobook-merger')
+
+
+class AudioFileInfo:
+    __slots__ = (
+        'file_name', 'duration', 'codec', 'profile', 'sample_rate',
+        'channels', 'bit_rate', 'frames', 'chapters', 'tags',
+    )
+
+    def __init__(
+        self,
+        file_name,
+        duration,
+        codec=None,
+        profile=None,
+        sample_rate=0,
+        channels=0,
+        bit_rate=0,
+        frames=0,
+        chapters=None,
+        tags=None
+    ):
+        self.file_name = file_name
+        self.duration = duration
+        self.codec = codec
+        self.profile = profile
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.bit_rate = bit_rate
+        # the number of audio packets, if the container records it
+        self.frames = frames
+        # list of (start, end, title) with times in seconds
+        self.chapters = chapters or []
+        self.tags = tags or {}
+
+    @staticmethod
+    def from_ffprobe(file_name, probe):
+        format = probe.get('format', {})
+        streams = probe.get('streams', [])
+        if not streams:
+            raise RuntimeError(f'No audio stream in "{file_name}"')
+        stream = streams[0]
+
+        return AudioFileInfo(
+            file_name,
+            float(format['duration']),
+            codec=stream.get('codec_name'),
+            profile=stream.get('profile'),
+            sample_rate=int(stream.get('sample_rate', 0)),
+            channels=int(stream.get('channels', 0)),
+            bit_rate=int(stream.get('bit_rate', format.get('bit_rate', 0))),
+            frames=int(stream.get('nb_frames', 0)),
+            chapters=[
+                (float(c['start_time']),
+                 float(c['end_time']),
+                 c.get('tags', {}).get('title', ''))
+                for c in probe.get('chapters', [])
+            ],
+            tags=format.get('tags', {}))
+
+    @staticmethod
+    def from_dict(file_name, d):
+        return AudioFileInfo(
+            file_name,
+            d['duration'],
+            codec=d['codec'],
+            profile=d.get('profile'),
+            sample_rate=d['sample_rate'],
+            channels=d['channels'],
+            bit_rate=d['bit_rate'],
+            frames=d.get('frames', 0),
+            chapters=[tuple(c) for c in d['chapters']],
+            tags=d['tags'])
+
+    def to_dict(self):
+        return {
+            'duration': self.duration,
+            'codec': self.codec,
+            'profile': self.profile,
+            'sample_rate': self.sample_rate,
+            'channels': self.channels,
+            'bit_rate': self.bit_rate,
+            'frames': self.frames,
+            'chapters': self.chapters,
+            'tags': self.tags,
+        }
+
+
+def _run_ffprobe(file_name):
+    output, _ = run_custom(['ffprobe',
+                            '-v', 'error',
+                            '-show_format',
+                            '-show_chapters',
+                            '-show_streams',
+                            '-select_streams', 'a:0',
+                            '-of', 'json',
+                            '-i', file_name])
+    return AudioFileInfo.from_ffprobe(file_name, json.loads(output))
+
+
+# probes the file's format, audio stream, chapters and tags in one go
+def probe_file(file_name, cache=None):
+    if cache:
+        with profiler.stage('read probe cache'):
+            record = cache.get(file_name)
+        if record and 'probe' in record:
+            return AudioFileInfo.from_dict(file_name, record['probe'])
+
+    with profiler.stage('ffprobe'):
+        info = _run_ffprobe(file_name)
+
+    if cache:
+        cache.update(file_name, {'probe': info.to_dict()})
+    return info
 
 
 def _copy_metadata(metadata, overrides):
@@ -375,239 +1227,2094 @@ def merge_metadata(*overrides):
     return metadata
 
 
+# escape special characters (‘=’, ‘;’, ‘#’, ‘\’ and a newline)
+def escape_ffmetadata(value):
+    return re.sub(r'([;=#\\\n])', lambda m: f'\\{m.group(0)}', str(value))
+
+
+# replace the characters that can't be in a file name on some systems (‘<’,
+# ‘>’, ‘:’, ‘"’, ‘/’, ‘\’, ‘|’, ‘?’, ‘*’ and control characters)
+def escape_filename(value):
+    return re.sub(r'[<>:"/\\|?*\x00-\x1f]', '_', str(value)).strip(' .')
+
+
+# yields (start, end, name) for each chapter, with times in milliseconds
+def chapter_marks(chapters, file_duration=lambda info: info.duration):
+    chapter_start = 0
+    chapter_end = 0
+
+    for chapter in chapters:
+        for info in chapter['files']:
+            # tot up chapter lengths
+            chapter_end += file_duration(info) * 1000
+
+        yield chapter_start, chapter_end, chapter['name']
+
+        chapter_start = chapter_end
+
+
 def write_metadata_file(
     metadata,
     chapters,
-    output_file
+    output_file,
+    file_duration=lambda info: info.duration
 ):
-    chapter_start = 0
-    chapter_end = 0
-    num_segments = 0
-
     output_file.write(';FFMETADATA1\n')
 
     for key, value in metadata.items():
-        output_file.write(f'{key}={value}\n')
+        output_file.write(
+            f'{escape_ffmetadata(key)}={escape_ffmetadata(value)}\n')
 
-    for chapter in chapters:
+    for start, end, name in chapter_marks(chapters, file_duration):
         output_file.write('\n[CHAPTER]\n')
         output_file.write('TIMEBASE=1/1000\n')
 
-        for (file, duration) in chapter['files']:
-            # tot up chapter lengths
-            chapter_end += duration * 1000
+        # add to chapter metadata
+        output_file.write(f'START={start}\n')
+        output_file.write(f'END={end}\n')
 
-            # accumulate the number of audio segments
-            num_segments += 1
+        output_file.write(f'title={escape_ffmetadata(name)}\n')
 
-        # add to chapter metadata
-        output_file.write(f'START={chapter_start}\n')
-        output_file.write(f'END={chapter_end}\n')
 
-        # escape special characters (‘=’, ‘;’, ‘#’, ‘\’ and a newline)
-        escaped=re.sub(r'([;=#\\])', lambda m: f'\\{m.group(0)}', chapter['name'])
-        output_file.write(f'title={escaped}\n')
+def _write_all(fd, data):
+    start_time = time.perf_counter() if profiler.enabled else None
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+    if start_time is not None:
+        profiler.add('write to encoder', time.perf_counter() - start_time)
 
-        chapter_start = chapter_end
 
+# Copies everything (or up to limit bytes) from one pipe to another. Where
+# possible the data is spliced between the pipes in the kernel (and the time
+# it takes is profiled under label); otherwise it's copied through a reusable
+# buffer.
+def _copy_pipe(input_file, output_fd, buffer, progress=None, limit=None,
+               label='splice to encoder'):
+    total = 0
+    use_splice = hasattr(os, 'splice')
+    while True:
+        size = len(buffer) if limit is None else min(len(buffer), limit - total)
+        if size == 0:
+            return total
 
-def write_merged_audio_file(chapters, ffmetadata_filename, album_art_filename, output_filename):
-    # create a temporary file that we'll use to overwrite the original
-    _, temp_filename = make_temporary_filename(output_filename)
+        if use_splice:
+            start_time = time.perf_counter() if profiler.enabled else None
+            try:
+                size = os.splice(input_file.fileno(), output_fd, size)
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                use_splice = False
+                continue
+            # this also waits for the decoder if it's behind
+            if start_time is not None:
+                profiler.add(label, time.perf_counter() - start_time)
+        else:
+            size = input_file.readinto(buffer[:size])
+            _write_all(output_fd, buffer[:size])
 
-    # Build a commandline for the *output*
-    encode_cmd = FFmpegCommandLine()
-    encode_cmd.add_file('pipe:0', map=True, stream_index='a', pre_input_args=[
-        '-f', 's16le',
-        '-ac', '2',
-        '-ar', '44100'
-    ])
-    encode_cmd.add_metadata_file(ffmetadata_filename)
-    if album_art_filename:
-        encode_cmd.add_album_art_to_index(album_art_filename)
-    encode_cmd.add_args('-acodec', 'aac')
-    encode_cmd.set_output(temp_filename, True)
+        if size == 0:
+            return total
+        total += size
+        if progress:
+            progress(size)
 
-    try:
-        # This is the output process. We'll stream data to this via its stdin.
-        output_process = run_stream(encode_cmd.get_cmdline())
-
-        # Open the input pipe and send each file over for processing
-        files = []
-        for chapter in chapters:
-            for file, duration in chapter['files']:
-                files.append(file)
-
-        with tqdm(total=len(files)) as pbar:
-            for file in files:
-                pbar.set_description(f'Writing {file}')
-
-                decode_cmd = FFmpegCommandLine(format='s16le')
-                decode_cmd.add_file(file)
-                decode_cmd.add_args(
-                    '-ac', '2',
-                    '-ar', '44100'
-                )
-                decode_cmd.set_output('-', overwrite=True)
-
-                # convert the file to PCM on-the-fly
-                input_data, _ = run_custom(decode_cmd.get_cmdline())
-
-                # check the process health
-                ret = output_process.poll()
-                if ret:
-                    err = bytes.decode(output_process.stderr.read())
-                    raise RuntimeError(f'ffmpeg aborted unexpectedly: {err}')
-
-                # Send the data to the output process
-                output_process.stdin.write(input_data)
-                pbar.update(1)
 
-        # Close the door!
-        output_process.stdin.close()
+# The format of the PCM audio passed between processes
+class PcmFormat:
+    def __init__(self, sample_rate, channels):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        # signed 16-bit samples
+        self.frame_bytes = 2 * channels
 
-        # Wait for the write to complete
-        output_process.wait()
+    def args(self):
+        return ('-ac', str(self.channels), '-ar', str(self.sample_rate))
 
-        # Grab output and error
-        retcode = output_process.poll()
-        if retcode:
-            raise RuntimeError('ffmpeg') # todo: error handling
+    # the arguments that convert a file's audio to this format, if it isn't
+    # already in it
+    def conversion_args(self, info):
+        args = []
+        if info.channels != self.channels:
+            args.extend(['-ac', str(self.channels)])
+        if info.sample_rate != self.sample_rate:
+            args.extend(['-ar', str(self.sample_rate)])
+        return tuple(args)
 
-        # move the file over the original
-        shutil.move(temp_filename, output_filename)
-    except Exception as e:
-        # Something went wrong, so delete the temporary file
-        delete_temporary_file(temp_filename)
-        # Rethrow the error
-        raise e
 
-def update_audio_file(ffmetadata_filename, album_art_filename, output_filename):
-    # create a temporary file that we'll use to overwrite the original
-    _, temp_filename = make_temporary_filename(output_filename)
+# Picks a format that all the inputs can be converted to without losing
+# anything: the highest sample rate and the most channels among them
+def negotiate_pcm_format(infos, sample_rate=None, channels=None):
+    return PcmFormat(
+        sample_rate or max(info.sample_rate for info in infos),
+        channels or max(info.channels for info in infos))
 
-    # Build a commandline
-    copy_cmd = FFmpegCommandLine()
-    copy_cmd.add_file(output_filename, map=True, stream_index='a')
-    copy_cmd.add_metadata_file(ffmetadata_filename)
-    if album_art_filename:
-        copy_cmd.add_album_art_to_index(album_art_filename)
-    copy_cmd.add_args('-acodec', 'copy')
-    copy_cmd.set_output(temp_filename, True)
 
-    try:
-        # annotate the original with the "copy" codec
-        run_custom(copy_cmd.get_cmdline(), capture_stdout=False)
+# a command line that writes a file's audio to stdout
+def _decode_cmdline(file_name, format='s16le', args=()):
+    decode_cmd = FFmpegCommandLine(format=format)
+    decode_cmd.add_file(file_name)
+    decode_cmd.add_args(*args)
+    decode_cmd.set_output('-', overwrite=True)
+    return decode_cmd.get_cmdline()
 
-        # move the file over the original
-        shutil.move(temp_filename, output_filename)
-    except Exception as e:
-        # Something went wrong, so delete the temporary file
-        delete_temporary_file(temp_filename)
-        # Rethrow the exception
-        raise e
 
+# marks the point where a DecodeStream's reader stops buffering
+_HANDOFF = object()
 
-def get_chapter_metadata(input_chapters):
-    chapters = []
 
-    # quickly tally the number of files
-    file_count = 0
-    for input_chapter in input_chapters:
-        file_count += len(input_chapter['files'])
-
-    with tqdm(total=file_count) as pbar:
-        for input_chapter in input_chapters:
-            files = []
-            c = {
-                'name': input_chapter['name'],
-                'files': files
-            }
-            for file in input_chapter['files']:
-                pbar.set_description(f'Analyzing {file}')
+# Writes the same chunks to several pipes, each from a thread of its own, so
+# the encoders reading them run in parallel. One that's slower than the rest
+# only holds them up once it's max_chunks behind.
+class FanOut:
+    def __init__(self, fds, max_chunks=FAN_OUT_CHUNKS):
+        self._queues = [queue.Queue(maxsize=max_chunks) for _ in fds]
+        self._error = None
+        self._writers = [
+            threading.Thread(target=self._write, args=(fd, chunks),
+                             daemon=True)
+            for fd, chunks in zip(fds, self._queues)
+        ]
+        for writer in self._writers:
+            writer.start()
 
-                # Probe the file for length
-                duration_str, err = run_custom(['ffprobe',
-                                            '-i', file,
-                                            '-show_entries', 'format=duration',
-                                            '-v', 'error',
-                                            '-of', 'csv=p=0'])
+    def _write(self, fd, chunks):
+        while (chunk := chunks.get()) is not None:
+            # after an error, keep taking chunks so write() can't block
+            if self._error:
+                continue
+            try:
+                _write_all(fd, chunk)
+            except Exception as e:
+                self._error = e
 
-                # Add tuple of name and duration
-                files.append((file, float(duration_str.strip())))
+    def write(self, chunk):
+        if self._error:
+            raise self._error
+        for chunks in self._queues:
+            chunks.put(chunk)
 
-                pbar.update(1)
+    # waits for everything to be written
+    def close(self):
+        for chunks in self._queues:
+            chunks.put(None)
+        for writer in self._writers:
+            writer.join()
+        if self._error:
+            raise self._error
 
-            chapters.append(c)
 
-    return chapters
+# Decodes a file to PCM (or remuxes it to another stream format) in the
+# background, holding at most max_chunks chunks of its output in memory until
+# it's forwarded
+class DecodeStream:
+    def __init__(
+        self,
+        file_name,
+        max_chunks,
+        format='s16le',
+        args=(),
+        group=None
+    ):
+        self.file_name = file_name
+        self._cmdline = _decode_cmdline(file_name, format, args)
 
+        self._chunks = queue.Queue(maxsize=max_chunks)
+        self._error = None
+        self._closed = False
+        self._handoff = threading.Event()
+        # a decoder that's waiting for its output to be forwarded isn't
+        # stalled, so it's only watched while forwarding
+        self._process = (group or ProcessGroup()).start(
+            self._cmdline, watch=False)
+        # read unbuffered so nothing is left behind when splicing starts
+        self._stdout = self._process.stdout.raw
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
 
-def parse_command_line():
-    parser = argparse.ArgumentParser()
+    def _read_chunk(self):
+        chunk = bytearray(PCM_CHUNK_SIZE)
+        view = memoryview(chunk)
+        size = 0
+        while size < len(chunk):
+            count = self._stdout.readinto(view[size:])
+            if count == 0:
+                break
+            size += count
+        view.release()
+        del chunk[size:]
+        return chunk
 
-    parser.add_argument('input_filenames', type=str, nargs='+', metavar="FILE",
-                        help='A manifest, or CSV file listing <"file","chapter">.')
-    parser.add_argument('-o', '--output', type=str, required=False,
-                        dest='output_filename',
-                        help='The output filename.')
-    parser.add_argument('-u', '--update', action='store_true',
-                        dest='update_only',
-                        help="Update metadata only; don't process audio data.")
-    parser.add_argument('--no-default-meta', action='store_true',
-                        help="*Don't* overwrite metadata with some built-in defaults.")
-    parser.add_argument('--no-inherit-meta', action='store_true',
-                        help="*Don't* inherit metadata from the first input file.")
-    parser.add_argument('-r', '--root', type=str, dest='root_dir',
-                        help="The base directory to work from.")
+    def _read(self):
+        end = None
+        try:
+            while not self._closed:
+                # once forwarding starts, the rest of the output goes directly
+                # from the decoder's pipe to the encoder's
+                if self._handoff.is_set():
+                    end = _HANDOFF
+                    break
+                chunk = self._read_chunk()
+                if not chunk:
+                    break
+                self._process.touch()
+                self._chunks.put(chunk)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._chunks.put(end)
 
-    args = parser.parse_args()
+    # writes the decoded PCM to output_fd, or a FanOut, in order and returns
+    # its size
+    def forward(self, output_fd, buffer, progress=None):
+        fan_out = isinstance(output_fd, FanOut)
+        # a FanOut needs every chunk, so there's no splicing to hand off to
+        if not fan_out:
+            self._handoff.set()
+        self._process.touch()
+        self._process.watched = True
 
-    if len(args.input_filenames) == 0:
-        raise RuntimeError('Expected input filenames')
+        def on_forward(size):
+            self._process.touch()
+            if progress:
+                progress(size)
 
-    # Derive a filename if output file is not provided
-    if not args.output_filename:
-        args.output_filename = f'{Path(args.input_filenames[0]).stem}.m4b'
+        # send what has already been buffered
+        forwarded = 0
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None or chunk is _HANDOFF:
+                break
+            if fan_out:
+                output_fd.write(chunk)
+            else:
+                _write_all(output_fd, chunk)
+            forwarded += len(chunk)
+            on_forward(len(chunk))
 
-    # Ensure both input and output paths are fully qualified
-    args.input_filenames = [os.path.abspath(x) for x in args.input_filenames]
-    args.output_filename = os.path.abspath(args.output_filename)
+        if self._error:
+            raise self._error
 
-    # Derive the root if not provided
-    if not args.root_dir:
-        args.root_dir = os.path.dirname(args.input_filenames[0])
+        # then the remainder, without it passing through Python
+        if chunk is _HANDOFF:
+            forwarded += _copy_pipe(
+                self._stdout, output_fd, buffer, on_forward)
 
-    return args
+        # the decoder has closed its output, so check how it went
+        if self._process.wait():
+            raise self._process.error()
+        return forwarded
 
+    # stops the decoder and releases anything it has buffered
+    def close(self):
+        self._closed = True
+        self._process.kill()
+        # unblock the reader if it's waiting for space in the queue
+        while self._reader.is_alive():
+            try:
+                self._chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._process.wait()
 
-if __name__ == '__main__':
-    # parse command line
-    args = parse_command_line()
 
-    # set the current working directory to the directory of the input file
-    # so that relative paths work correctly
-    os.chdir(args.root_dir)
+# Inputs can be joined without re-encoding if they're all AAC-LC in the output
+# format, and their containers say how many frames they hold (so chapter
+# times can be worked out exactly)
+def can_stream_copy(chapters, pcm_format):
+    return all(
+        info.codec == 'aac' and
+        info.profile == 'LC' and
+        info.frames > 0 and
+        info.sample_rate == pcm_format.sample_rate and
+        info.channels == pcm_format.channels
+        for chapter in chapters for info in chapter['files'])
 
-    # Read the manifest(s)
-    manifest = Manifest()
-    for input_file in args.input_filenames:
-        if input_file.endswith('.csv'):
-            CsvParser(input_file, manifest)
-        else:
-            ManifestParser(input_file, manifest)
 
-    # Abort if there are no files
-    if len(manifest.files) == 0:
-        raise RuntimeError(
-            f'No input files in {",".join(args.input_filenames)}')
+# The length of a file once its packets are copied into the output: unlike
+# decoding, this includes the encoder delay and padding
+def stream_copy_duration(info):
+    return info.frames * AAC_FRAME_SIZE / info.sample_rate
 
-    # get metadata from the first file and merge it into all the rest
-    title = Path(args.input_filenames[0]).stem
-    default_metadata = {
-        'genre': 'Audiobook',
-        'title': title,
-        'album': title,
+
+def write_merged_audio_file(
+    chapters,
+    ffmetadata_filename,
+    album_art_filename,
+    output_filename,
+    prefetch=DEFAULT_PREFETCH,
+    buffer_size=DEFAULT_BUFFER_SIZE,
+    stream_copy=False,
+    pcm_format=None,
+    bit_rate=None,
+    variants=()
+):
+    # Each variant is encoded from the same decoded audio as the output, by
+    # an encoder of its own running alongside the output's
+    outputs = [
+        OutputSpec(output_filename, 'copy') if stream_copy
+        else OutputSpec(output_filename, bit_rate=bit_rate),
+        *variants
+    ]
+
+    # create temporary files that we'll use to overwrite the originals
+    temp_filenames = [
+        make_temporary_filename(output.file_name)[1] for output in outputs
+    ]
+
+    # Open the input pipe and send each file over for processing
+    infos = []
+    for chapter in chapters:
+        infos.extend(chapter['files'])
+
+    # When stream copying, each file is remuxed to ADTS rather than decoded,
+    # and the output process just muxes the joined stream.
+    pcm_format = pcm_format or negotiate_pcm_format(infos)
+    if stream_copy:
+        stream_format, stream_args = 'adts', lambda info: STREAM_COPY_ARGS
+        input_args = ['-f', 'aac']
+    else:
+        stream_format, stream_args = 's16le', pcm_format.conversion_args
+        input_args = ['-f', 's16le', *pcm_format.args()]
+
+    # Build a commandline for each *output*
+    encode_cmds = []
+    for output, temp_filename in zip(outputs, temp_filenames):
+        encode_cmd = FFmpegCommandLine(format=output.format)
+        encode_cmd.add_file('pipe:0', map=True, stream_index='a',
+                            pre_input_args=input_args)
+        if ffmetadata_filename:
+            encode_cmd.add_metadata_file(ffmetadata_filename)
+        if album_art_filename and output.format in ALBUM_ART_FORMATS:
+            encode_cmd.add_album_art_to_index(album_art_filename)
+        encode_cmd.add_args(*output.encode_args())
+        encode_cmd.set_output(temp_filename, True)
+        encode_cmds.append(encode_cmd)
+
+    # The file being written and the next few are decoded at the same time.
+    # Split the buffer between them so memory use is bounded regardless of
+    # how long each file is.
+    max_chunks = max(1, buffer_size // ((prefetch + 1) * PCM_CHUNK_SIZE))
+    decoders = []
+    fan_out = None
+    group = ProcessGroup()
+
+    try:
+        # These are the output processes. We'll stream data to them via their
+        # stdin. They're only ever waiting for a decoder, or holding one up,
+        # so it's the decoder being forwarded that's watched for stalls.
+        output_processes = [
+            group.start(encode_cmd.get_cmdline(), pipe_stdin=True,
+                        capture_stdout=False, watch=False)
+            for encode_cmd in encode_cmds
+        ]
+        # a single output is spliced to directly
+        if len(output_processes) > 1:
+            output = fan_out = FanOut(
+                [process.stdin.fileno() for process in output_processes])
+        else:
+            output = output_processes[0].stdin.fileno()
+
+        def close_outputs():
+            try:
+                if fan_out:
+                    fan_out.close()
+            finally:
+                for process in output_processes:
+                    process.stdin.close()
+
+        # if a decoder failed first, that's what stopped the encoder
+        def encoder_error():
+            # let the others finish so it's clear which one failed
+            with contextlib.suppress(OSError):
+                close_outputs()
+            for process in output_processes:
+                if process.wait():
+                    return group.first_failure(
+                        process.error('ffmpeg aborted unexpectedly'))
+            return group.first_failure(
+                RuntimeError('ffmpeg aborted unexpectedly'))
+
+        # reused for copying when the pipes can't be spliced together
+        buffer = memoryview(bytearray(PCM_CHUNK_SIZE))
+        forwarded = 0
+        # the exact length of each file's decoded audio
+        file_samples = []
+        start_time = time.monotonic()
+
+        # Progress is measured in seconds of audio, so that long files count
+        # for more than short ones. Decoded audio is counted as it's
+        # forwarded; remuxed audio only once each file is done. The length
+        # of each file isn't known up front with --single-pass.
+        durations_known = all(info.duration is not None for info in infos)
+        total = sum(info.duration for info in infos) \
+            if durations_known else None
+        bytes_per_second = pcm_format.frame_bytes * pcm_format.sample_rate
+        with progress_bar('merge', total, unit='s') as pbar:
+            done_seconds = 0
+
+            def progress(size):
+                nonlocal forwarded, file_seconds
+                forwarded += size
+                rate = forwarded / max(time.monotonic() - start_time, 1e-6)
+                pbar.set_postfix_str(f'{rate / (1024 * 1024):.1f}MiB/s',
+                                     refresh=False)
+                if not stream_copy:
+                    file_seconds += size / bytes_per_second
+                    # don't run past the file's probed length
+                    if durations_known:
+                        file_seconds = min(file_seconds, info.duration)
+                    pbar.update(done_seconds + file_seconds - pbar.n)
+
+            next_file = 0
+            for info in infos:
+                pbar.set_file('Writing', info.file_name)
+                file_seconds = 0
+
+                # keep the next few files decoding in the background
+                while next_file < len(infos) and \
+                        len(decoders) < prefetch + 1:
+                    next_info = infos[next_file]
+                    decoders.append(DecodeStream(
+                        next_info.file_name, max_chunks,
+                        stream_format, stream_args(next_info), group))
+                    next_file += 1
+
+                decoder = decoders.pop(0)
+                try:
+                    # Send the data to the output processes
+                    with profiler.stage('decode'):
+                        file_bytes = decoder.forward(output, buffer, progress)
+                    file_samples.append(file_bytes // pcm_format.frame_bytes)
+                except BrokenPipeError:
+                    raise encoder_error() from None
+                finally:
+                    decoder.close()
+
+                # make up any difference from the file's probed length
+                done_seconds += info.duration if durations_known \
+                    else file_seconds
+                pbar.update(done_seconds - pbar.n)
+
+        # Close the door!
+        try:
+            close_outputs()
+        except BrokenPipeError:
+            raise encoder_error() from None
+
+        # Wait for the writes to complete
+        with profiler.stage('wait for encoder'):
+            retcodes = [process.wait() for process in output_processes]
+        if any(retcodes):
+            raise encoder_error()
+
+        # move the files over the originals
+        for output, temp_filename in zip(outputs, temp_filenames):
+            scratch.commit(temp_filename, output.file_name)
+
+        return {
+            'bytes_forwarded': forwarded,
+            'seconds': time.monotonic() - start_time,
+            'file_samples': None if stream_copy else file_samples,
+        }
+    except Exception as e:
+        # Something went wrong, so stop any processes that are still running
+        group.kill_all()
+        for decoder in decoders:
+            decoder.close()
+        if fan_out:
+            with contextlib.suppress(OSError):
+                fan_out.close()
+        # delete the temporary files
+        for temp_filename in temp_filenames:
+            delete_temporary_file(temp_filename)
+        # Rethrow the error, or whichever failure caused it
+        raise group.first_failure(e)
+
+# Merges the files with a single ffmpeg process rather than decoding each
+# one in its own process and piping the audio to the encoder
+# whether one ffmpeg can open this many inputs at once, raising the soft
+# limit on open files as far as the hard limit if it has to
+def can_open_files(file_count):
+    if resource is None:
+        return True
+    needed = file_count + CONCAT_SPARE_FILES
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or needed <= soft:
+        return True
+    if hard != resource.RLIM_INFINITY and needed > hard:
+        return False
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+    except (ValueError, OSError):
+        return False
+    return True
+
+
+def write_concatenated_audio_file(
+    chapters,
+    ffmetadata_filename,
+    album_art_filename,
+    output_filename,
+    pcm_format=None
+):
+    infos = []
+    for chapter in chapters:
+        infos.extend(chapter['files'])
+    pcm_format = pcm_format or negotiate_pcm_format(infos)
+
+    # create a temporary file that we'll use to overwrite the original
+    _, temp_filename = make_temporary_filename(output_filename)
+
+    # Build a commandline. The concat filter decodes each input separately
+    # (so encoder delay and padding are trimmed per file, as they are when
+    # each file is decoded in its own process) and converts them all to a
+    # common format.
+    encode_cmd = FFmpegCommandLine()
+    for info in infos:
+        encode_cmd.add_file(info.file_name)
+    inputs = ''.join(f'[{i}:a:0]' for i in range(len(infos)))
+    encode_cmd.add_args(
+        '-filter_complex', f'{inputs}concat=n={len(infos)}:v=0:a=1[a]',
+        '-map', '[a]')
+    encode_cmd.add_metadata_file(ffmetadata_filename)
+    if album_art_filename:
+        encode_cmd.add_album_art_to_index(album_art_filename)
+    encode_cmd.add_args(
+        *pcm_format.args(),
+        '-acodec', 'aac',
+        '-progress', 'pipe:1',
+        '-nostats')
+    encode_cmd.set_output(temp_filename, True)
+
+    try:
+        with ProcessGroup() as group, \
+                progress_bar('merge', sum(info.duration for info in infos),
+                             f'Writing {Path(output_filename).name}',
+                             unit='s') as pbar:
+            process = group.start(encode_cmd.get_cmdline())
+
+            # follow ffmpeg's progress reports
+            for line in process.stdout:
+                process.touch()
+                key, _, value = bytes.decode(line).strip().partition('=')
+                if key == 'out_time_us' and value.isdigit():
+                    pbar.update(
+                        min(int(value) / 1000000, pbar.total) - pbar.n)
+
+            if process.wait():
+                raise process.error()
+
+        # move the file over the original
+        scratch.commit(temp_filename, output_filename)
+    except Exception as e:
+        # Something went wrong, so delete the temporary file
+        delete_temporary_file(temp_filename)
+        # Rethrow the error
+        raise e
+
+
+# decodes a file and returns the exact number of samples it produces
+def count_samples(info, pcm_format, args=()):
+    decoder = DecodeStream(
+        info.file_name, 1, args=(*args, *pcm_format.conversion_args(info)))
+    try:
+        with open(os.devnull, 'wb') as null_file:
+            buffer = memoryview(bytearray(PCM_CHUNK_SIZE))
+            size = decoder.forward(null_file.fileno(), buffer)
+            return size // pcm_format.frame_bytes
+    finally:
+        decoder.close()
+
+
+def count_chapter_samples(chapters, pcm_format, jobs=None, journal=None):
+    infos = [info for chapter in chapters for info in chapter['files']]
+    counts = [journal.sample_count(info) if journal else None
+              for info in infos]
+    missing = [index for index, count in enumerate(counts) if count is None]
+    # every file is decoded, so the time taken goes by the audio's length
+    with progress_bar('measure', sum(infos[index].duration for index in missing),
+                      unit='s') as pbar, \
+            ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(count_samples, infos[index], pcm_format): index
+            for index in missing
+        }
+        try:
+            for future in as_completed(futures):
+                index = futures[future]
+                pbar.set_file('Measuring', infos[index].file_name)
+                counts[index] = future.result()
+                if journal:
+                    journal.record_sample_count(infos[index], counts[index])
+                pbar.update(infos[index].duration)
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+    return counts
+
+
+# Splits the chapters into at most num_shards contiguous runs of roughly equal
+# duration, and returns the index of the first file of each
+def plan_shards(chapters, num_shards):
+    total = sum(info.duration for c in chapters for info in c['files'])
+    starts = [0]
+    elapsed = 0
+    file_index = 0
+    for chapter in chapters[:-1]:
+        elapsed += sum(info.duration for info in chapter['files'])
+        file_index += len(chapter['files'])
+        if len(starts) < num_shards and \
+                elapsed >= total * len(starts) / num_shards:
+            starts.append(file_index)
+    return starts
+
+
+# the index of the first file of each chapter
+def chapter_starts(chapters):
+    starts = []
+    file_index = 0
+    for chapter in chapters:
+        starts.append(file_index)
+        file_index += len(chapter['files'])
+    return starts
+
+
+def iter_adts_frames(file):
+    while header := file.read(7):
+        if len(header) < 7 or header[0] != 0xFF or (header[1] & 0xF0) != 0xF0:
+            raise RuntimeError(f'Bad ADTS frame in "{file.name}"')
+        length = ((header[3] & 0x03) << 11) | (header[4] << 3) | (header[5] >> 5)
+        body = file.read(length - 7)
+        if len(body) < length - 7:
+            raise RuntimeError(f'Truncated ADTS frame in "{file.name}"')
+        yield header + body
+
+
+# Encodes audio to an ADTS file from a list of (info, skip, size) parts, where
+# skip and size are in bytes of decoded PCM and a size of None means the rest
+# of the file
+def _encode_parts(parts, output_filename, pcm_format):
+    encode_cmd = FFmpegCommandLine(format='adts')
+    encode_cmd.add_file('pipe:0', map=True, stream_index='a',
+                        pre_input_args=['-f', 's16le', *pcm_format.args()])
+    encode_cmd.add_args('-acodec', 'aac')
+    encode_cmd.set_output(output_filename, True)
+
+    buffer = memoryview(bytearray(PCM_CHUNK_SIZE))
+    with ProcessGroup() as group:
+        # as with write_merged_audio_file, the decoders are watched for stalls
+        encoder = group.start(
+            encode_cmd.get_cmdline(), pipe_stdin=True, capture_stdout=False,
+            watch=False)
+        try:
+            with open(os.devnull, 'wb') as null_file:
+                for info, skip, size in parts:
+                    decoder = group.start(_decode_cmdline(
+                        info.file_name, args=pcm_format.conversion_args(info)))
+
+                    def progress(size):
+                        decoder.touch()
+
+                    try:
+                        stdout = decoder.stdout.raw
+                        _copy_pipe(stdout, null_file.fileno(), buffer,
+                                   progress, limit=skip, label='skip to shard')
+                        try:
+                            _copy_pipe(stdout, encoder.stdin.fileno(), buffer,
+                                       progress, limit=size)
+                        except BrokenPipeError:
+                            break
+                    finally:
+                        # stop decoding once we have what we need
+                        if size is not None:
+                            decoder.kill()
+                        stdout.close()
+                        retcode = decoder.wait()
+                    if size is None and retcode:
+                        raise decoder.error()
+
+            encoder.stdin.close()
+            if encoder.wait():
+                raise encoder.error()
+        except Exception as e:
+            raise group.first_failure(e)
+
+
+# The parts of the files that make up the samples [start, end) of the
+# concatenated files, as (info, skip, size) for _encode_parts
+def _shard_parts(infos, offsets, counts, start, end, pcm_format):
+    parts = []
+    for info, offset, count in zip(infos, offsets, counts):
+        if offset + count <= start or offset >= end:
+            continue
+
+        # send only the part of the file that's inside the shard
+        skip = max(start - offset, 0) * pcm_format.frame_bytes
+        size = None if offset + count <= end \
+            else (end - max(start, offset)) * pcm_format.frame_bytes
+        parts.append((info, skip, size))
+    return parts
+
+
+def _file_fingerprint(file_name):
+    file_name = os.path.abspath(file_name)
+    st = os.stat(file_name)
+    return [file_name, st.st_size, st.st_mtime_ns]
+
+
+# Records the progress of a merge with --resume in a work directory: the exact
+# length of each file, and each shard once it has been encoded. Both are
+# keyed by the files they came from (and how they're decoded), so a merge
+# that's interrupted, or stopped by a bad file, can be run again and only
+# redo what's missing or made from files that have changed since.
+class ResumeJournal:
+    def __init__(self, work_dir, pcm_format):
+        self._work_dir = work_dir
+        self._pcm_format = pcm_format
+        self._journal_filename = os.path.join(work_dir, 'journal.jsonl')
+        self._sample_counts = {}
+        self._shards = {}
+        os.makedirs(work_dir, exist_ok=True)
+
+        complete = self._read()
+        self._journal_file = open(
+            self._journal_filename, 'a', encoding='utf-8')
+        # an entry cut short by a crash mustn't run into the next one
+        if not complete:
+            self._journal_file.write('\n')
+
+    # reads the entries so far, and returns whether the last one is whole
+    def _read(self):
+        try:
+            journal_file = open(self._journal_filename, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return True
+        line = ''
+        with journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('version') != JOURNAL_VERSION:
+                    continue
+                if entry['type'] == 'samples':
+                    self._sample_counts[entry['key']] = entry['samples']
+                elif entry['type'] == 'shard':
+                    self._shards[entry['key']] = entry['size']
+        return not line or line.endswith('\n')
+
+    def _append(self, entry):
+        self._journal_file.write(json.dumps(
+            {'version': JOURNAL_VERSION, **entry}) + '\n')
+        self._journal_file.flush()
+        os.fsync(self._journal_file.fileno())
+
+    def close(self):
+        self._journal_file.close()
+
+    def _file_key(self, info):
+        return hashlib.sha256(json.dumps([
+            _file_fingerprint(info.file_name),
+            self._pcm_format.args(),
+            self._pcm_format.conversion_args(info),
+        ]).encode('utf-8')).hexdigest()
+
+    def sample_count(self, info):
+        return self._sample_counts.get(self._file_key(info))
+
+    def record_sample_count(self, info, count):
+        key = self._file_key(info)
+        self._sample_counts[key] = count
+        self._append({'type': 'samples', 'key': key, 'samples': count})
+
+    def shard_key(self, parts):
+        return hashlib.sha256(json.dumps([
+            [self._file_key(info), skip, size] for info, skip, size in parts
+        ]).encode('utf-8')).hexdigest()
+
+    def shard_filename(self, key):
+        return os.path.join(self._work_dir, f'{key}.aac')
+
+    # whether the shard was finished, and is still there in full
+    def has_shard(self, key):
+        try:
+            return os.path.getsize(self.shard_filename(key)) == \
+                self._shards.get(key)
+        except OSError:
+            return False
+
+    # Encodes a shard into the work directory. This runs on the worker
+    # threads, so the shard is recorded afterwards with record_shard.
+    def encode_shard(self, parts, key):
+        fd, temp_filename = tempfile.mkstemp(
+            dir=self._work_dir, suffix='.tmp.aac')
+        os.close(fd)
+        try:
+            _encode_parts(parts, temp_filename, self._pcm_format)
+            with open(temp_filename, 'rb') as shard_file:
+                os.fsync(shard_file.fileno())
+            os.replace(temp_filename, self.shard_filename(key))
+        except Exception as e:
+            delete_temporary_file(temp_filename)
+            raise e
+
+    def record_shard(self, key):
+        size = os.path.getsize(self.shard_filename(key))
+        self._shards[key] = size
+        self._append({'type': 'shard', 'key': key, 'size': size})
+
+
+# Encodes the book in shards concurrently and joins them without re-encoding.
+#
+# Every shard but the first starts a few AAC frames early so its encoder is
+# primed with the audio that comes before it, and those frames are dropped
+# when the shards are joined. Likewise every shard but the last drops its
+# final frame, which was encoded against the silence after its end. The
+# frames on either side of each join then both encode the real audio, so the
+# join is gapless and the output has exactly the samples of a single encode.
+#
+# With a work_dir, every chapter is a shard of its own, and each one is kept
+# there as soon as it's encoded, so that if the merge is interrupted, running
+# it again only encodes the chapters that weren't finished. The shards are
+# planned the same way every time, so the output doesn't depend on whether
+# the merge was interrupted. The work_dir is removed once the output is done.
+def write_sharded_audio_file(
+    chapters,
+    ffmetadata_filename,
+    album_art_filename,
+    output_filename,
+    num_shards,
+    jobs=None,
+    pcm_format=None,
+    work_dir=None
+):
+    infos = [info for chapter in chapters for info in chapter['files']]
+    pcm_format = pcm_format or negotiate_pcm_format(infos)
+    journal = ResumeJournal(work_dir, pcm_format) if work_dir else None
+
+    try:
+        counts = _write_shards(
+            chapters, infos, ffmetadata_filename, album_art_filename,
+            output_filename, num_shards, jobs, pcm_format, journal)
+    finally:
+        if journal:
+            journal.close()
+    if journal:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'file_samples': counts,
+    }
+
+
+def _write_shards(
+    chapters,
+    infos,
+    ffmetadata_filename,
+    album_art_filename,
+    output_filename,
+    num_shards,
+    jobs,
+    pcm_format,
+    journal
+):
+    # shard boundaries have to land on AAC frames, which needs exact lengths
+    counts = count_chapter_samples(chapters, pcm_format, jobs, journal)
+    offsets = [0]
+    for count in counts:
+        offsets.append(offsets[-1] + count)
+    total = offsets.pop()
+
+    starts = chapter_starts(chapters) if journal \
+        else plan_shards(chapters, num_shards)
+    boundaries = [0]
+    for file_index in starts[1:]:
+        boundary = offsets[file_index] // AAC_FRAME_SIZE * AAC_FRAME_SIZE
+        if boundary > boundaries[-1]:
+            boundaries.append(boundary)
+    shards = []
+    for index, start in enumerate(boundaries):
+        end = boundaries[index + 1] if index + 1 < len(boundaries) else total
+        preroll = min(start, SHARD_PREROLL_FRAMES * AAC_FRAME_SIZE)
+        shards.append((start - preroll, end, preroll // AAC_FRAME_SIZE))
+    shard_parts = [
+        _shard_parts(infos, offsets, counts, start, end, pcm_format)
+        for start, end, _ in shards
+    ]
+
+    # create a temporary file that we'll use to overwrite the original
+    _, temp_filename = make_temporary_filename(output_filename)
+    if journal:
+        shard_dir = None
+        shard_keys = [journal.shard_key(parts) for parts in shard_parts]
+        shard_filenames = [journal.shard_filename(key) for key in shard_keys]
+    else:
+        shard_dir = tempfile.mkdtemp(
+            dir=scratch.dir_for(output_filename),
+            prefix=Path(output_filename).stem, suffix='.tmp')
+        shard_filenames = [
+            os.path.join(shard_dir, f'{index}.aac')
+            for index in range(len(shards))
+        ]
+
+    def encode_shard(index):
+        if journal:
+            journal.encode_shard(shard_parts[index], shard_keys[index])
+        else:
+            _encode_parts(
+                shard_parts[index], shard_filenames[index], pcm_format)
+
+    # shards finished by an earlier attempt are reused
+    todo = [
+        index for index in range(len(shards))
+        if not journal or not journal.has_shard(shard_keys[index])
+    ]
+
+    def shard_seconds(index):
+        start, end, drop = shards[index]
+        return (end - start - drop * AAC_FRAME_SIZE) / pcm_format.sample_rate
+
+    # the joined stream starts with the encoder delay, which the muxer trims
+    # just as it would for a single encode
+    mux_cmd = FFmpegCommandLine()
+    mux_cmd.add_file('pipe:0', map=True, stream_index='a', pre_input_args=[
+        '-itsoffset', repr(-AAC_FRAME_SIZE / pcm_format.sample_rate),
+        '-f', 'aac'
+    ])
+    mux_cmd.add_metadata_file(ffmetadata_filename)
+    if album_art_filename:
+        mux_cmd.add_album_art_to_index(album_art_filename)
+    mux_cmd.add_args('-acodec', 'copy')
+    mux_cmd.set_output(temp_filename, True)
+
+    try:
+        with progress_bar('encode', sum(shard_seconds(i) for i in todo),
+                          'Encoding shards', unit='s') as pbar, \
+                ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(encode_shard, index): index for index in todo
+            }
+            try:
+                for future in as_completed(futures):
+                    index = futures[future]
+                    future.result()
+                    if journal:
+                        journal.record_shard(shard_keys[index])
+                    pbar.update(shard_seconds(index))
+            except BaseException:
+                executor.shutdown(wait=True, cancel_futures=True)
+                # keep the shards the other workers managed to finish
+                if journal:
+                    for future, index in futures.items():
+                        if not future.cancelled() and \
+                                future.exception() is None and \
+                                not journal.has_shard(shard_keys[index]):
+                            journal.record_shard(shard_keys[index])
+                raise
+
+        with ProcessGroup() as group:
+            mux_process = group.start(
+                mux_cmd.get_cmdline(), pipe_stdin=True, capture_stdout=False)
+            mux_fd = mux_process.stdin.fileno()
+            try:
+                for index, ((_, _, drop), shard_filename) in \
+                        enumerate(zip(shards, shard_filenames)):
+                    last_shard = index + 1 == len(shards)
+                    with open(shard_filename, 'rb') as shard_file:
+                        pending = None
+                        for frame_index, frame in enumerate(
+                                iter_adts_frames(shard_file)):
+                            if frame_index < drop:
+                                continue
+                            if pending:
+                                _write_all(mux_fd, pending)
+                                mux_process.touch()
+                            pending = frame
+                        if pending and last_shard:
+                            _write_all(mux_fd, pending)
+                mux_process.stdin.close()
+            except BrokenPipeError:
+                pass
+            if mux_process.wait():
+                raise mux_process.error()
+
+        # move the file over the original
+        scratch.commit(temp_filename, output_filename)
+        return counts
+    except BaseException as e:
+        # Something went wrong (or the merge was interrupted, which --resume
+        # expects), so delete the temporary file
+        delete_temporary_file(temp_filename)
+        # Rethrow the error
+        raise e
+    finally:
+        if shard_dir:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+
+# Keeps the encoded audio of each chapter so that rebuilding a book only
+# encodes the chapters whose files have changed. Segments are stitched
+# together with stream copy, so each one keeps its own encoder delay and
+# padding: a few tens of milliseconds of silence at each chapter boundary.
+class SegmentStore:
+    # books built at the same time share the index of outputs, and don't
+    # evict the segments each other are using
+    _index_lock = threading.Lock()
+    _in_use = collections.Counter()
+
+    def __init__(
+        self,
+        segment_dir,
+        pcm_format,
+        max_size=DEFAULT_SEGMENT_CACHE_SIZE
+    ):
+        self._segment_dir = segment_dir
+        self._pcm_format = pcm_format
+        self._max_size = max_size
+        self._index_filename = os.path.join(segment_dir, 'outputs.json')
+        self._keys = []
+        os.makedirs(segment_dir, exist_ok=True)
+
+    # identifies a chapter's audio by its files and how they're encoded, so
+    # renaming the chapter doesn't invalidate it
+    def chapter_key(self, chapter):
+        fingerprint = {
+            'version': SEGMENT_VERSION,
+            'encoder': [*self._pcm_format.args(), '-acodec', 'aac'],
+            'files': [_file_fingerprint(info.file_name)
+                      for info in chapter['files']],
+        }
+        return hashlib.sha256(
+            json.dumps(fingerprint).encode('utf-8')).hexdigest()
+
+    def _segment_filename(self, key):
+        return os.path.join(self._segment_dir, f'{key}.aac')
+
+    def _info_filename(self, key):
+        return os.path.join(self._segment_dir, f'{key}.json')
+
+    def _write_json(self, file_name, value):
+        fd, temp_filename = tempfile.mkstemp(
+            dir=self._segment_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as output_file:
+                json.dump(value, output_file)
+            os.replace(temp_filename, file_name)
+        except Exception as e:
+            delete_temporary_file(temp_filename)
+            raise e
+
+    def _has_segment(self, key):
+        return os.path.isfile(self._segment_filename(key)) and \
+            os.path.isfile(self._info_filename(key))
+
+    def _encode_segment(self, chapter, key):
+        fd, temp_filename = tempfile.mkstemp(
+            dir=self._segment_dir, suffix='.tmp.aac')
+        os.close(fd)
+        try:
+            _encode_parts(
+                [(info, 0, None) for info in chapter['files']],
+                temp_filename,
+                self._pcm_format)
+            with open(temp_filename, 'rb') as segment_file:
+                frames = sum(1 for _ in iter_adts_frames(segment_file))
+
+            # the info is written first, so a segment is never without it
+            self._write_json(self._info_filename(key), {'frames': frames})
+            os.replace(temp_filename, self._segment_filename(key))
+        except Exception as e:
+            delete_temporary_file(temp_filename)
+            raise e
+
+    def _segment_info(self, key):
+        with open(self._info_filename(key), 'r', encoding='utf-8') as info_file:
+            frames = json.load(info_file)['frames']
+        return AudioFileInfo(
+            self._segment_filename(key),
+            frames * AAC_FRAME_SIZE / self._pcm_format.sample_rate,
+            codec='aac',
+            profile='LC',
+            sample_rate=self._pcm_format.sample_rate,
+            channels=self._pcm_format.channels,
+            frames=frames)
+
+    # Encodes the chapters that aren't stored yet. Returns the chapters with
+    # each one's files replaced by its segment, and a key for the audio of
+    # the whole book.
+    def encode(self, chapters, jobs=None):
+        keys = [self.chapter_key(chapter) for chapter in chapters]
+        with self._index_lock:
+            self._in_use.update(keys)
+            self._keys.extend(keys)
+
+        missing = {}
+        for chapter, key in zip(chapters, keys):
+            if key not in missing and not self._has_segment(key):
+                missing[key] = chapter
+            elif key not in missing:
+                # mark the segment as recently used
+                os.utime(self._segment_filename(key))
+
+        with progress_bar('encode', sum(
+                    info.duration
+                    for chapter in missing.values()
+                    for info in chapter['files']),
+                'Encoding chapters', unit='s') as pbar, \
+                ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(self._encode_segment, chapter, key):
+                    sum(info.duration for info in chapter['files'])
+                for key, chapter in missing.items()
+            }
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    pbar.update(futures[future])
+            except BaseException:
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+
+        segment_chapters = [
+            {'name': chapter['name'], 'files': [self._segment_info(key)]}
+            for chapter, key in zip(chapters, keys)
+        ]
+        audio_key = hashlib.sha256('\n'.join(keys).encode('utf-8')).hexdigest()
+        return segment_chapters, audio_key
+
+    def _read_index(self):
+        try:
+            with open(self._index_filename, 'r', encoding='utf-8') as index_file:
+                return json.load(index_file)
+        except (OSError, ValueError):
+            return {}
+
+    # whether the output was last written with this audio and hasn't been
+    # modified since
+    def is_current(self, output_filename, audio_key):
+        entry = self._read_index().get(os.path.abspath(output_filename))
+        try:
+            st = os.stat(output_filename)
+        except OSError:
+            return False
+        return entry == [audio_key, st.st_size, st.st_mtime_ns]
+
+    def record_output(self, output_filename, audio_key):
+        with self._index_lock:
+            index = self._read_index()
+            st = os.stat(output_filename)
+            index[os.path.abspath(output_filename)] = \
+                [audio_key, st.st_size, st.st_mtime_ns]
+            self._write_json(self._index_filename, index)
+
+    # Lets the segments this book used be evicted again, then evicts the least
+    # recently used segments until the store fits
+    def close(self):
+        with self._index_lock:
+            self._in_use.subtract(self._keys)
+            self._keys = []
+            in_use = {key for key, count in self._in_use.items() if count > 0}
+
+            segments = []
+            total_size = 0
+            with os.scandir(self._segment_dir) as it:
+                for entry in it:
+                    if not entry.name.endswith('.aac') or \
+                            entry.name.endswith('.tmp.aac'):
+                        continue
+                    st = entry.stat()
+                    total_size += st.st_size
+                    key = entry.name[:-len('.aac')]
+                    if key not in in_use:
+                        segments.append((st.st_mtime, st.st_size, key))
+
+            segments.sort()
+            for _, size, key in segments:
+                if total_size <= self._max_size:
+                    break
+                try:
+                    # the audio goes first, as a segment needs both
+                    os.remove(self._segment_filename(key))
+                    total_size -= size
+                    os.remove(self._info_filename(key))
+                except OSError as e:
+                    eprint(f'Warning: couldn\'t evict segment "{key}": {e}')
+
+
+# MP4 boxes that hold nothing but other boxes
+MP4_CONTAINER_BOXES = {
+    b'moov', b'trak', b'mdia', b'minf', b'stbl', b'udta', b'edts', b'dinf',
+    b'tref', b'ilst',
+}
+# MP4 boxes that hold other boxes after a version and flags
+MP4_FULL_CONTAINER_BOXES = {b'meta'}
+
+# how ffmpeg's metadata keys are stored in an iTunes-style ilst box
+ILST_TEXT_TAGS = {
+    'title': b'\xa9nam',
+    'artist': b'\xa9ART',
+    'album_artist': b'aART',
+    'album': b'\xa9alb',
+    'composer': b'\xa9wrt',
+    'encoder': b'\xa9too',
+    'comment': b'\xa9cmt',
+    'genre': b'\xa9gen',
+    'copyright': b'cprt',
+    'grouping': b'\xa9grp',
+    'lyrics': b'\xa9lyr',
+    'description': b'desc',
+    'synopsis': b'ldes',
+    'show': b'tvsh',
+    'episode_id': b'tven',
+    'network': b'tvnn',
+    'date': b'\xa9day',
+    'sort_name': b'sonm',
+    'sort_artist': b'soar',
+    'sort_album_artist': b'soaa',
+    'sort_album': b'soal',
+    'sort_composer': b'soco',
+    'sort_show': b'sosn',
+    'keywords': b'keyw',
+}
+# the tags ffmpeg stores as numbers, with the size of each in bytes
+ILST_INT_TAGS = {
+    'episode_sort': (b'tves', 4),
+    'season_number': (b'tvsn', 4),
+    'media_type': (b'stik', 1),
+    'hd_video': (b'hdvd', 1),
+    'gapless_playback': (b'pgap', 1),
+    'compilation': (b'cpil', 1),
+    'tmpo': (b'tmpo', 2),
+}
+MP4_MAX_CHPL_CHAPTERS = 255
+# an 'encd' box marking a chapter title as UTF-8, as ffmpeg writes it
+MP4_TEXT_ENCODING_BOX = b'\x00\x00\x00\x0cencd\x00\x00\x01\x00'
+
+
+class Mp4Box:
+    def __init__(self, type, payload=b'', children=None, prefix=b''):
+        self.type = type
+        self.payload = payload
+        self.children = children
+        # the version and flags of a full box that contains other boxes
+        self.prefix = prefix
+
+    @staticmethod
+    def parse_all(data):
+        boxes = []
+        offset = 0
+        while offset < len(data):
+            if len(data) - offset < 8:
+                raise RuntimeError('Truncated MP4 box')
+            size, type = struct.unpack_from('>I4s', data, offset)
+            header_size = 8
+            if size == 1:
+                size, = struct.unpack_from('>Q', data, offset + 8)
+                header_size = 16
+            elif size == 0:
+                size = len(data) - offset
+            if size < header_size or offset + size > len(data):
+                raise RuntimeError(f'Bad size for MP4 box "{type}"')
+
+            body = data[offset + header_size:offset + size]
+            if type in MP4_CONTAINER_BOXES:
+                boxes.append(Mp4Box(type, children=Mp4Box.parse_all(body)))
+            elif type in MP4_FULL_CONTAINER_BOXES:
+                boxes.append(Mp4Box(type, children=Mp4Box.parse_all(body[4:]),
+                                    prefix=body[:4]))
+            else:
+                boxes.append(Mp4Box(type, payload=body))
+            offset += size
+        return boxes
+
+    def to_bytes(self):
+        if self.children is None:
+            body = self.payload
+        else:
+            body = self.prefix + b''.join(c.to_bytes() for c in self.children)
+        if len(body) + 8 > 0xFFFFFFFF:
+            return struct.pack('>I4sQ', 1, self.type, len(body) + 16) + body
+        return struct.pack('>I4s', len(body) + 8, self.type) + body
+
+    def find(self, *path):
+        box = self
+        for type in path:
+            box = next((c for c in box.children or [] if c.type == type), None)
+            if not box:
+                return None
+        return box
+
+    def find_all(self, type):
+        return [c for c in self.children or [] if c.type == type]
+
+    def replace(self, type, box):
+        for index, child in enumerate(self.children):
+            if child.type == type:
+                self.children[index] = box
+                return
+        self.children.append(box)
+
+
+# reads a (version 0 or 1) field that is 32 bits in version 0 and 64 in 1
+def _mp4_versioned_field(payload, offset_v0, offset_v1):
+    if payload[0] == 1:
+        return struct.unpack_from('>Q', payload, offset_v1)[0]
+    return struct.unpack_from('>I', payload, offset_v0)[0]
+
+
+def _mp4_set_versioned_field(box, offset_v0, offset_v1, value):
+    payload = bytearray(box.payload)
+    if payload[0] == 1:
+        struct.pack_into('>Q', payload, offset_v1, value)
+    else:
+        struct.pack_into('>I', payload, offset_v0, min(value, 0xFFFFFFFF))
+    box.payload = bytes(payload)
+
+
+def _mp4_handler_type(trak):
+    hdlr = trak.find(b'mdia', b'hdlr')
+    return hdlr.payload[8:12] if hdlr else None
+
+
+def _mp4_track_id(trak):
+    return _mp4_versioned_field(trak.find(b'tkhd').payload, 12, 20)
+
+
+# returns the offset and size of the chapter titles, if they're all together
+def _mp4_chapter_data(trak):
+    stbl = trak.find(b'mdia', b'minf', b'stbl')
+    stco = stbl.find(b'stco')
+    co64 = stbl.find(b'co64')
+    stsz = stbl.find(b'stsz')
+    if stco and struct.unpack_from('>I', stco.payload, 4)[0] == 1:
+        offset, = struct.unpack_from('>I', stco.payload, 8)
+    elif co64 and struct.unpack_from('>I', co64.payload, 4)[0] == 1:
+        offset, = struct.unpack_from('>Q', co64.payload, 8)
+    else:
+        return None
+    if not stsz:
+        return None
+    sample_size, count = struct.unpack_from('>II', stsz.payload, 4)
+    if sample_size:
+        return offset, sample_size * count
+    return offset, sum(struct.unpack_from(f'>{count}I', stsz.payload, 12))
+
+
+# the header of a free box of the given size, which covers its contents
+def _mp4_free_header(size):
+    if size < 1 << 32:
+        return struct.pack('>I4s', size, b'free')
+    return struct.pack('>I4sQ', 1, b'free', size)
+
+
+def _ilst_item(type, data_type, value):
+    data = Mp4Box(b'data', payload=struct.pack('>II', data_type, 0) + value)
+    return Mp4Box(type, children=[data])
+
+
+def _make_ilst(metadata, album_art_filename, old_ilst):
+    items = []
+    for key, value in metadata.items():
+        if key in ILST_TEXT_TAGS:
+            items.append(_ilst_item(
+                ILST_TEXT_TAGS[key], 1, str(value).encode('utf-8')))
+        elif key in ('track', 'disc'):
+            # stored as a pair of numbers, e.g. "3/12"
+            number, _, total = str(value).partition('/')
+            try:
+                value = struct.pack(
+                    '>HHHH', 0, int(number), int(total or 0), 0)
+            except ValueError:
+                continue
+            items.append(_ilst_item(
+                b'trkn' if key == 'track' else b'disk', 0, value))
+        elif key in ILST_INT_TAGS:
+            type, size = ILST_INT_TAGS[key]
+            try:
+                number = int(str(value).strip())
+            except ValueError:
+                continue
+            format = {1: '>B', 2: '>H', 4: '>I'}[size]
+            # 21 for a signed integer
+            items.append(_ilst_item(type, 21, struct.pack(
+                format, number & ((1 << size * 8) - 1))))
+
+    # keep the encoder and cover from before unless they've been replaced
+    item_types = {item.type for item in items}
+    if old_ilst:
+        for type in (b'\xa9too', b'covr'):
+            old_item = old_ilst.find(type)
+            if old_item and type not in item_types and \
+                    not (type == b'covr' and album_art_filename):
+                items.append(old_item)
+
+    if album_art_filename:
+        with open(album_art_filename, 'rb') as art_file:
+            art = art_file.read()
+        # 14 for PNG, 13 for JPEG
+        data_type = 14 if art.startswith(b'\x89PNG') else 13
+        items.append(_ilst_item(b'covr', data_type, art))
+
+    return Mp4Box(b'ilst', children=items)
+
+
+def _make_chpl(chapter_marks):
+    # the count is a single byte, so like ffmpeg, only the first 255 chapters
+    # are listed here (the text track has them all)
+    chapter_marks = chapter_marks[:MP4_MAX_CHPL_CHAPTERS]
+    payload = bytearray(struct.pack('>IIB', 0x01000000, 0, len(chapter_marks)))
+    for start, _, name in chapter_marks:
+        title = name.encode('utf-8')[:255]
+        # start times are in units of 100ns
+        payload += struct.pack('>QB', int(start) * 10000, len(title)) + title
+    return Mp4Box(b'chpl', payload=bytes(payload))
+
+
+# Points the chapter text track at new samples holding the chapter titles,
+# and returns the samples' data
+def _update_chapter_track(moov, trak, chapter_marks, data_offset):
+    mdhd = trak.find(b'mdia', b'mdhd')
+    stbl = trak.find(b'mdia', b'minf', b'stbl')
+    timescale = _mp4_versioned_field(mdhd.payload, 12, 20)
+    movie_timescale = _mp4_versioned_field(moov.find(b'mvhd').payload, 12, 20)
+
+    samples = []
+    durations = []
+    for start, end, name in chapter_marks:
+        title = name.encode('utf-8')
+        samples.append(
+            struct.pack('>H', len(title)) + title + MP4_TEXT_ENCODING_BOX)
+        durations.append(
+            int(end) * timescale // 1000 - int(start) * timescale // 1000)
+    duration = sum(durations)
+
+    stbl.replace(b'stts', Mp4Box(b'stts', payload=struct.pack(
+        f'>II{2 * len(durations)}I', 0, len(durations),
+        *[x for d in durations for x in (1, d)])))
+    stbl.replace(b'stsz', Mp4Box(b'stsz', payload=struct.pack(
+        f'>III{len(samples)}I', 0, 0, len(samples),
+        *[len(s) for s in samples])))
+    stbl.replace(b'stsc', Mp4Box(b'stsc', payload=struct.pack(
+        '>IIIII', 0, 1, 1, len(samples), 1)))
+    # all the samples are in a single chunk
+    stbl.children = [c for c in stbl.children if c.type not in (b'stco', b'co64')]
+    if data_offset > 0xFFFFFFFF:
+        stbl.children.append(Mp4Box(b'co64', payload=struct.pack(
+            '>IIQ', 0, 1, data_offset)))
+    else:
+        stbl.children.append(Mp4Box(b'stco', payload=struct.pack(
+            '>III', 0, 1, data_offset)))
+    # the old sync sample table no longer matches the samples
+    stbl.children = [c for c in stbl.children if c.type != b'stss']
+
+    # update the track's durations
+    _mp4_set_versioned_field(mdhd, 16, 24, duration)
+    movie_duration = duration * movie_timescale // timescale
+    _mp4_set_versioned_field(trak.find(b'tkhd'), 20, 28, movie_duration)
+    elst = trak.find(b'edts', b'elst')
+    if elst and struct.unpack_from('>I', elst.payload, 4)[0] == 1:
+        _mp4_set_versioned_field(elst, 8, 8, movie_duration)
+
+    return b''.join(samples)
+
+
+# Rewrites the tags, chapters and cover of an MP4 file without copying its
+# audio. The new moov box goes where the old one was if it fits (using any
+# free boxes after it as padding); otherwise it's appended and the old one
+# becomes a free box. A moov at the end of the file is never overwritten,
+# as it's the only copy: the new one goes in the space freed by an earlier
+# update, if it fits, or is appended. Returns False, leaving the file
+# untouched, if it isn't laid out in a way that this can handle.
+def update_mp4_in_place(
+    file_name,
+    metadata,
+    chapter_marks,
+    album_art_filename
+):
+    with open(file_name, 'r+b') as mp4_file:
+        # find the top-level boxes without reading the audio
+        file_size = os.fstat(mp4_file.fileno()).st_size
+        top_level = []
+        offset = 0
+        while offset < file_size:
+            mp4_file.seek(offset)
+            header = mp4_file.read(16)
+            if len(header) < 8:
+                return False
+            size, type = struct.unpack_from('>I4s', header)
+            if size == 1:
+                size, = struct.unpack_from('>Q', header, 8)
+            elif size == 0:
+                size = file_size - offset
+            if size < 8 or offset + size > file_size:
+                return False
+            top_level.append((type, offset, size))
+            offset += size
+
+        moovs = [(o, s) for t, o, s in top_level if t == b'moov']
+        if len(moovs) != 1 or top_level[0][0] != b'ftyp':
+            return False
+        moov_offset, moov_size = moovs[0]
+
+        mp4_file.seek(moov_offset)
+        moov, = Mp4Box.parse_all(mp4_file.read(moov_size))
+
+        # find the audio track and the text track holding its chapter titles
+        traks = moov.find_all(b'trak')
+        audio_traks = [t for t in traks if _mp4_handler_type(t) == b'soun']
+        if len(audio_traks) != 1:
+            return False
+        chap = audio_traks[0].find(b'tref', b'chap')
+        chapter_ids = struct.unpack(f'>{len(chap.payload) // 4}I',
+                                    chap.payload) if chap else ()
+        chapter_traks = [t for t in traks if _mp4_track_id(t) in chapter_ids]
+        if len(chapter_traks) > 1 or \
+                chapter_traks and _mp4_handler_type(chapter_traks[0]) != b'text':
+            return False
+        # adding a chapter track is a job for ffmpeg
+        if chapter_marks and not chapter_traks:
+            return False
+
+        # The space the new boxes can take: the old moov and any free boxes
+        # after it. The chapter titles written by an earlier update sit in
+        # their own mdat just before the moov, so that can be reused too.
+        index = next(i for i, b in enumerate(top_level) if b[1] == moov_offset)
+        first = index
+        space = moov_size
+        if index > 0 and chapter_traks and \
+                top_level[index - 1][0] == b'mdat' and \
+                _mp4_chapter_data(chapter_traks[0]) == (
+                    top_level[index - 1][1] + 8, top_level[index - 1][2] - 8):
+            first = index - 1
+            moov_offset = top_level[first][1]
+            space += top_level[first][2]
+        at_end = True
+        for type, _, size in top_level[index + 1:]:
+            if type not in (b'free', b'skip'):
+                at_end = False
+                break
+            space += size
+        # and the free boxes before it, left by an earlier update
+        free_offset = moov_offset
+        for type, offset, _ in reversed(top_level[1:first]):
+            if type not in (b'free', b'skip'):
+                break
+            free_offset = offset
+
+        def build(data_offset):
+            if chapter_traks:
+                samples = _update_chapter_track(
+                    moov, chapter_traks[0], chapter_marks, data_offset + 8)
+                chapter_data = Mp4Box(b'mdat', payload=samples).to_bytes()
+            else:
+                chapter_data = b''
+
+            udta = moov.find(b'udta')
+            if not udta:
+                udta = Mp4Box(b'udta', children=[])
+                moov.children.append(udta)
+            meta = udta.find(b'meta')
+            if not meta:
+                meta = Mp4Box(b'meta', children=[Mp4Box(
+                    b'hdlr', payload=b'\0' * 8 + b'mdirappl' + b'\0' * 9)],
+                    prefix=b'\0' * 4)
+                udta.children.append(meta)
+            meta.replace(b'ilst', _make_ilst(
+                metadata, album_art_filename, meta.find(b'ilst')))
+            udta.children = [c for c in udta.children if c.type != b'chpl']
+            if chapter_marks:
+                udta.children.append(_make_chpl(chapter_marks))
+
+            return chapter_data + moov.to_bytes()
+
+        if not at_end:
+            new_data = build(moov_offset)
+            padding = space - len(new_data)
+            if padding == 0 or padding >= 8:
+                # overwrite the old moov, padding out the rest of the space
+                mp4_file.seek(moov_offset)
+                mp4_file.write(new_data)
+                if padding:
+                    mp4_file.write(_mp4_free_header(padding))
+                mp4_file.flush()
+                os.fsync(mp4_file.fileno())
+                return True
+        elif free_offset < moov_offset:
+            # The moov is at the end, after the space an earlier update
+            # freed, so the new one can go there. The old one is only cut off
+            # once the new one is safely on disk.
+            new_data = build(free_offset)
+            padding = moov_offset - free_offset - len(new_data)
+            if padding == 0 or padding >= 8:
+                mp4_file.seek(free_offset)
+                mp4_file.write(new_data)
+                if padding:
+                    mp4_file.write(_mp4_free_header(padding))
+                mp4_file.flush()
+                os.fsync(mp4_file.fileno())
+                mp4_file.truncate(moov_offset)
+                mp4_file.flush()
+                os.fsync(mp4_file.fileno())
+                return True
+
+        # append the new moov and then free the old one, along with the
+        # chapter titles before it if they were part of the space
+        new_data = build(file_size)
+        mp4_file.seek(file_size)
+        mp4_file.write(new_data)
+        mp4_file.flush()
+        os.fsync(mp4_file.fileno())
+        mp4_file.seek(moov_offset)
+        mp4_file.write(_mp4_free_header(space))
+        mp4_file.flush()
+        os.fsync(mp4_file.fileno())
+    return True
+
+
+def update_audio_file(ffmetadata_filename, album_art_filename, output_filename):
+    # create a temporary file that we'll use to overwrite the original
+    _, temp_filename = make_temporary_filename(output_filename)
+
+    # Build a commandline
+    output_format = OutputSpec(output_filename).format
+    copy_cmd = FFmpegCommandLine(format=output_format)
+    copy_cmd.add_file(output_filename, map=True, stream_index='a')
+    copy_cmd.add_metadata_file(ffmetadata_filename)
+    if album_art_filename and output_format in ALBUM_ART_FORMATS:
+        copy_cmd.add_album_art_to_index(album_art_filename)
+    copy_cmd.add_args('-acodec', 'copy')
+    copy_cmd.set_output(temp_filename, True)
+
+    try:
+        # annotate the original with the "copy" codec
+        # (it writes nothing as it goes, so it can't be judged by its output)
+        run_custom(copy_cmd.get_cmdline(), capture_stdout=False, watch=False)
+
+        # move the file over the original
+        scratch.commit(temp_filename, output_filename)
+    except Exception as e:
+        # Something went wrong, so delete the temporary file
+        delete_temporary_file(temp_filename)
+        # Rethrow the exception
+        raise e
+
+
+# Checks that a merged file decodes from start to end without errors, and to
+# about the length its chapters add up to
+def verify_audio_file(file_name, expected_duration):
+    info = _run_ffprobe(file_name)
+    pcm_format = PcmFormat(info.sample_rate, info.channels)
+    # stop at the first broken packet rather than skipping it
+    samples = count_samples(info, pcm_format, ('-xerror',))
+
+    duration = samples / pcm_format.sample_rate
+    tolerance = VERIFY_TOLERANCE / pcm_format.sample_rate
+    if abs(duration - expected_duration) > tolerance:
+        raise RuntimeError(
+            f'Expected "{file_name}" to be {expected_duration:.3f}s long, '
+            f'but it decodes to {duration:.3f}s')
+
+
+def get_chapter_metadata(input_chapters, jobs=None, cache=None):
+    # flatten the files so they can be probed in any order
+    files = []
+    for input_chapter in input_chapters:
+        files.extend(input_chapter.files)
+
+    infos = [None] * len(files)
+
+    # the durations aren't known until the files have been probed, which
+    # takes about as long for any file
+    with progress_bar('analyze', len(files)) as pbar, \
+            ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(probe_file, file, cache): index
+            for index, file in enumerate(files)
+        }
+        try:
+            for future in as_completed(futures):
+                index = futures[future]
+                pbar.set_file('Analyzing', files[index])
+                try:
+                    infos[index] = future.result()
+                except Exception as e:
+                    raise RuntimeError(
+                        f'Failed to analyze "{files[index]}":\n{e}') from e
+                pbar.update(1)
+        except BaseException:
+            # don't start any more probes; the running ones finish quickly
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+    # rebuild the chapters in their original order
+    chapters = []
+    infos = iter(infos)
+    for input_chapter in input_chapters:
+        chapters.append({
+            'name': input_chapter.name,
+            'files': [next(infos) for _ in input_chapter.files]
+        })
+
+    return chapters
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('input_filenames', type=str, nargs='+', metavar="FILE",
+                        help='A manifest, a CSV file listing '
+                             '<"file","chapter">, or a directory of audio '
+                             'files with a subdirectory for each chapter.')
+    parser.add_argument('-o', '--output', type=str, required=False,
+                        dest='output_filename',
+                        help='The output filename.')
+    parser.add_argument('--bitrate', type=str,
+                        help="The bit rate to encode the output at, such as "
+                             "64k. Defaults to ffmpeg's choice for the codec.")
+    parser.add_argument('--variant', type=str, action='append', default=[],
+                        dest='variants', metavar='FILE[,codec=C][,bitrate=R]',
+                        help="Also write the book to FILE, encoded from the "
+                             "same decoded audio as the output. The codec "
+                             "defaults to one that suits FILE's extension. "
+                             "Can be given more than once.")
+    parser.add_argument('-u', '--update', action='store_true',
+                        dest='update_only',
+                        help="Update metadata only; don't process audio data.")
+    parser.add_argument('--no-default-meta', action='store_true',
+                        help="*Don't* overwrite metadata with some built-in defaults.")
+    parser.add_argument('--no-inherit-meta', action='store_true',
+                        help="*Don't* inherit metadata from the first input file.")
+    parser.add_argument('-r', '--root', type=str, dest='root_dir',
+                        help="The base directory to work from.")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help="The number of files to analyze concurrently.")
+    parser.add_argument('--engine', choices=['pipe', 'concat', 'sharded'],
+                        default='pipe',
+                        help="How to merge the files: decode each one in its "
+                             "own ffmpeg process and pipe the audio to the "
+                             "encoder, concatenate them all in one ffmpeg "
+                             "process, or encode runs of chapters "
+                             "concurrently and join them.")
+    parser.add_argument('--shards', type=int,
+                        help="The number of runs of chapters to encode "
+                             "separately with --engine sharded. Defaults to "
+                             "--jobs.")
+    parser.add_argument('--sample-rate', type=int,
+                        help="The sample rate of the output. Defaults to the "
+                             "highest sample rate of the inputs.")
+    parser.add_argument('--channels', type=int,
+                        help="The number of channels in the output. Defaults "
+                             "to the most channels of any input.")
+    parser.add_argument('--single-pass', action='store_true',
+                        help="Start encoding without analyzing the files "
+                             "first, and add the chapters afterwards from the "
+                             "exact length of each file's decoded audio. The "
+                             "output format defaults to the first file's.")
+    parser.add_argument('--no-copy', action='store_true',
+                        help="*Don't* join AAC inputs without re-encoding them, "
+                             "even if they are all compatible.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Keep each chapter's encoded audio, and only "
+                             "re-encode the chapters whose files have changed.")
+    parser.add_argument('--segment-dir', type=str,
+                        help="Where to keep encoded chapters for "
+                             "--incremental. Defaults to a directory in "
+                             "--cache-dir.")
+    parser.add_argument('--segment-cache-size', type=int,
+                        default=DEFAULT_SEGMENT_CACHE_SIZE // (1024 * 1024),
+                        help="The most encoded chapters to keep for "
+                             "--incremental, in MiB. The least recently "
+                             "used are evicted first.")
+    parser.add_argument('--resume', action='store_true',
+                        help="Encode each chapter separately and keep it as "
+                             "soon as it's done, so that if the merge is "
+                             "interrupted, running it again with --resume "
+                             "carries on from the chapters already encoded. "
+                             "Implies --engine sharded.")
+    parser.add_argument('--work-dir', type=str,
+                        help="Where to keep the work in progress for "
+                             "--resume. Defaults to the directory of the "
+                             "output.")
+    parser.add_argument('--scratch-dir', type=str,
+                        help="Where to write temporary files, e.g. a local "
+                             "disk when the output is on network storage. "
+                             "Each output is then copied into place once "
+                             "it's finished. Defaults to beside each output.")
+    parser.add_argument('--prefetch', type=int, default=DEFAULT_PREFETCH,
+                        help="The number of upcoming files to decode while "
+                             "writing the current one.")
+    parser.add_argument('--buffer-size', type=int,
+                        default=DEFAULT_BUFFER_SIZE // (1024 * 1024),
+                        help="The most decoded audio to hold in memory, in MiB.")
+    parser.add_argument('--stall-timeout', type=float,
+                        default=DEFAULT_STALL_TIMEOUT,
+                        help="Stop a merge if one of its ffmpeg processes "
+                             "makes no progress for this many seconds. 0 "
+                             "waits forever.")
+    parser.add_argument('--split', action='store_true',
+                        help="Split each of the books given (m4b files, say) "
+                             "into a file per chapter instead of merging. "
+                             "The files go in a folder named after the book, "
+                             "beside it or in --output-dir.")
+    parser.add_argument('--verify', action='store_true',
+                        help="Check that the merged book decodes from start "
+                             "to end, and that its length matches its "
+                             "chapters'.")
+    parser.add_argument('--checksum', action='store_true',
+                        help="Write the SHA-256 of each file given, and of "
+                             "every file in each folder given, in sha256sum's "
+                             "format instead of merging. Files that haven't "
+                             "changed since they were last hashed are looked "
+                             "up in the cache.")
+    parser.add_argument('--batch', action='store_true',
+                        help="Merge each manifest into its own book, rather "
+                             "than all of them into one. Directories are "
+                             "searched for manifests.")
+    parser.add_argument('--output-dir', type=str,
+                        help="Where to write the books with --batch, or the "
+                             "chapters with --split. Defaults to the "
+                             "directory of each manifest or book.")
+    parser.add_argument('--max-processes', type=int, default=os.cpu_count(),
+                        help="The most ffmpeg processes that books merged with "
+                             "--batch can run at once.")
+    parser.add_argument('--max-memory', type=int,
+                        default=DEFAULT_MAX_MEMORY // (1024 * 1024),
+                        help="The most decoded audio that books merged with "
+                             "--batch can hold in memory at once, in MiB.")
+    parser.add_argument('--watch', action='store_true',
+                        help="Keep running, and merge each manifest that "
+                             "appears or changes in the directories given, "
+                             "as with --batch.")
+    parser.add_argument('--settle', type=float, default=DEFAULT_SETTLE_TIME,
+                        help="How many seconds a manifest and its files must "
+                             "be unchanged before --watch merges it.")
+    parser.add_argument('--poll-interval', type=float,
+                        default=DEFAULT_POLL_INTERVAL,
+                        help="How often --watch checks for changes, in "
+                             "seconds, where inotify isn't available.")
+    parser.add_argument('--status-file', type=str,
+                        help="Where --watch keeps a JSON summary of its "
+                             "queue and throughput.")
+    parser.add_argument('--report', type=str,
+                        help="Write a JSON report of each book's result and "
+                             "timing with --batch.")
+    parser.add_argument('--progress-format', choices=['bar', 'jsonl'],
+                        default='bar',
+                        help="Show progress as bars, or write it as JSON lines "
+                             "(one event per line) for another program to "
+                             "follow.")
+    parser.add_argument('--progress-fd', type=int, default=2,
+                        help="The file descriptor to write JSON lines "
+                             "progress to. Defaults to stderr.")
+    parser.add_argument('--profile', type=str, metavar='REPORT',
+                        help="Time each stage of the merge and each process "
+                             "it runs, and write a JSON report to REPORT as "
+                             "well as a summary to stderr.")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="*Don't* cache file analysis between runs.")
+    parser.add_argument('--cache-dir', type=str, default=default_cache_dir(),
+                        help="Where to cache file analysis between runs.")
+
+    args = parser.parse_args()
+
+    if len(args.input_filenames) == 0:
+        raise RuntimeError('Expected input filenames')
+
+    if args.jobs < 1:
+        raise RuntimeError('Expected --jobs to be at least 1')
+    args.cache_dir = os.path.abspath(args.cache_dir)
+    if not args.segment_dir:
+        args.segment_dir = os.path.join(args.cache_dir, 'segments')
+    args.segment_dir = os.path.abspath(args.segment_dir)
+    if args.segment_cache_size < 0:
+        raise RuntimeError('Expected --segment-cache-size to be at least 0')
+    args.segment_cache_size *= 1024 * 1024
+
+    if args.shards is None:
+        args.shards = args.jobs
+    if args.shards < 1:
+        raise RuntimeError('Expected --shards to be at least 1')
+    if args.sample_rate is not None and args.sample_rate < 1:
+        raise RuntimeError('Expected --sample-rate to be at least 1')
+    if args.channels is not None and args.channels < 1:
+        raise RuntimeError('Expected --channels to be at least 1')
+    if args.single_pass and (args.update_only or args.incremental or
+                             args.engine != 'pipe'):
+        raise RuntimeError('Expected --single-pass without --update, '
+                           '--incremental or --engine other than pipe')
+    if args.resume and (args.single_pass or args.incremental):
+        raise RuntimeError('Expected --resume without --single-pass or '
+                           '--incremental')
+    if args.resume:
+        args.engine = 'sharded'
+    if args.work_dir:
+        args.work_dir = os.path.abspath(args.work_dir)
+    if args.scratch_dir:
+        args.scratch_dir = os.path.abspath(args.scratch_dir)
+        if not os.path.isdir(args.scratch_dir):
+            raise RuntimeError('Expected --scratch-dir to be a directory')
+    args.variants = [OutputSpec.parse(spec) for spec in args.variants]
+    if (args.variants or args.bitrate) and \
+            (args.engine != 'pipe' or args.incremental):
+        raise RuntimeError('Expected --variant and --bitrate without '
+                           '--incremental, --resume or --engine other than '
+                           'pipe')
+    if args.variants and (args.batch or args.watch):
+        raise RuntimeError('Expected --variant without --batch or --watch')
+    if args.prefetch < 0:
+        raise RuntimeError('Expected --prefetch to be at least 0')
+    if args.buffer_size < 1:
+        raise RuntimeError('Expected --buffer-size to be at least 1')
+    args.buffer_size *= 1024 * 1024
+    if args.stall_timeout < 0:
+        raise RuntimeError('Expected --stall-timeout to be at least 0')
+
+    if args.checksum and (args.output_filename or args.batch or args.watch or
+                          args.split or args.update_only or args.verify):
+        raise RuntimeError('Expected --checksum without --output, --batch, '
+                           '--watch, --split, --update or --verify')
+    if args.split:
+        if args.output_filename:
+            raise RuntimeError('Expected --output-dir rather than --output '
+                               'with --split')
+        if args.batch or args.watch or args.update_only or args.variants:
+            raise RuntimeError('Expected --split without --batch, --watch, '
+                               '--update or --variant')
+        if args.output_dir:
+            args.output_dir = os.path.abspath(args.output_dir)
+
+    if args.watch:
+        args.batch = True
+        if not all(os.path.isdir(x) for x in args.input_filenames):
+            raise RuntimeError('Expected directories with --watch')
+        if args.settle < 0:
+            raise RuntimeError('Expected --settle to be at least 0')
+        if args.poll_interval <= 0:
+            raise RuntimeError('Expected --poll-interval to be more than 0')
+        if args.status_file:
+            args.status_file = os.path.abspath(args.status_file)
+    if args.progress_format == 'jsonl':
+        try:
+            os.fstat(args.progress_fd)
+        except OSError:
+            raise RuntimeError(
+                'Expected --progress-fd to be an open file descriptor')
+    if args.profile:
+        args.profile = os.path.abspath(args.profile)
+    if args.batch:
+        if args.output_filename:
+            raise RuntimeError('Expected --output-dir rather than --output '
+                               'with --batch')
+        if args.max_processes < 1:
+            raise RuntimeError('Expected --max-processes to be at least 1')
+        if args.max_memory < 1:
+            raise RuntimeError('Expected --max-memory to be at least 1')
+        args.max_memory *= 1024 * 1024
+        if args.output_dir:
+            args.output_dir = os.path.abspath(args.output_dir)
+        if args.report:
+            args.report = os.path.abspath(args.report)
+
+    # Derive a filename if output file is not provided
+    if not args.output_filename and not args.batch and not args.split and \
+            not args.checksum:
+        args.output_filename = f'{input_title(args.input_filenames[0])}.m4b'
+
+    # Ensure both input and output paths are fully qualified (except when
+    # hashing, which names the files as they were given, like sha256sum)
+    if not args.checksum:
+        args.input_filenames = [
+            os.path.abspath(x) for x in args.input_filenames]
+    if args.output_filename:
+        args.output_filename = os.path.abspath(args.output_filename)
+
+    # Derive the root if not provided (each book has its own with --batch)
+    if not args.root_dir and not args.batch:
+        args.root_dir = os.path.dirname(args.input_filenames[0])
+
+    return args
+
+
+# the name of a manifest without its extension, or of a directory given in
+# place of one
+def input_title(input_filename):
+    if os.path.isdir(input_filename):
+        return os.path.basename(os.path.abspath(input_filename))
+    return Path(input_filename).stem
+
+
+# Reads the manifest(s) for one book, or scans the directories given in their
+# place. If root_dir is given, the files they list are made relative to it
+# rather than to the working directory.
+def read_manifests(input_filenames, root_dir=None, cache=None, jobs=None):
+    manifest = Manifest()
+    with profiler.stage('parse manifests'):
+        for input_file in input_filenames:
+            if os.path.isdir(input_file):
+                DirectoryScanner(input_file, manifest, cache, jobs)
+            elif input_file.endswith('.csv'):
+                CsvParser(input_file, manifest)
+            else:
+                ManifestParser(input_file, manifest)
+
+    # Abort if there are no files
+    if not manifest.chapters:
+        raise RuntimeError(
+            f'No input files in {",".join(input_filenames)}')
+
+    if root_dir:
+        for chapter in manifest.chapters:
+            chapter.files = [os.path.join(root_dir, f) for f in chapter.files]
+        if manifest.album_art:
+            manifest.album_art = os.path.join(root_dir, manifest.album_art)
+
+    # check the album art if any
+    if manifest.album_art and not os.path.isfile(manifest.album_art):
+        raise FileNotFoundError(f'File not found: {manifest.album_art}')
+
+    return manifest
+
+
+# where --resume keeps the work in progress on a book
+def resume_work_dir(args, output_filename):
+    return os.path.join(
+        args.work_dir or os.path.dirname(os.path.abspath(output_filename)),
+        f'{Path(output_filename).name}.resume')
+
+
+def merge_audiobook(args, manifest, input_filenames, output_filename,
+                    cache=None):
+    # progress events say which book they're for
+    progress_events.context.book = output_filename
+
+    if args.single_pass:
+        # only the first file is analyzed up front, for its tags and format;
+        # the length of each file is found while it's being encoded
+        first_info = probe_file(manifest.chapters[0].files[0], cache)
+        chapters = [{
+            'name': input_chapter.name,
+            'files': [AudioFileInfo(file, None)
+                      for file in input_chapter.files]
+        } for input_chapter in manifest.chapters]
+        format_infos = [first_info]
+    else:
+        # get chapter metadata from the input files
+        with profiler.stage('analyze files'):
+            chapters = get_chapter_metadata(
+                manifest.chapters, args.jobs, cache)
+        first_info = chapters[0]['files'][0]
+        format_infos = [info for chapter in chapters
+                        for info in chapter['files']]
+
+    # get metadata from the first file and merge it into all the rest
+    title = input_title(input_filenames[0])
+    default_metadata = {
+        'genre': 'Audiobook',
+        'title': title,
+        'album': title,
     }
     # delete some entries:
     cleanup_metadata = {
@@ -618,41 +3325,988 @@ if __name__ == '__main__':
         'TIT1': None,
     }
     metadata = merge_metadata(
-        get_file_metadata(manifest.files[0]) \
-            if not args.no_inherit_meta else {},
+        dict(first_info.tags) if not args.no_inherit_meta else {},
         cleanup_metadata,
         default_metadata if not args.no_default_meta else {},
         manifest.key_value_pairs
     )
 
-    # check the album art if any
-    if manifest.album_art and not os.path.isfile(manifest.album_art):
-        raise FileNotFoundError(f'File not found: {manifest.album_art}')
+    # decode to the best format the inputs have, unless told otherwise
+    pcm_format = negotiate_pcm_format(
+        format_infos,
+        args.sample_rate,
+        args.channels)
 
-    # get chapter metadata from the input files
-    chapters = get_chapter_metadata(manifest.chapters)
+    # only encode the chapters that have changed since the last build, then
+    # join them together (with --update too, as the segments' lengths are
+    # what the chapters were marked with)
+    update_only = args.update_only
+    segments = None
+    if args.incremental:
+        segments = SegmentStore(
+            args.segment_dir, pcm_format, args.segment_cache_size)
+        try:
+            with profiler.stage('encode chapters'):
+                chapters, audio_key = segments.encode(chapters, args.jobs)
+        except BaseException:
+            segments.close()
+            raise
+        # if the audio is unchanged, there's only metadata to update
+        update_only = update_only or \
+            segments.is_current(output_filename, audio_key)
+
+    # skip re-encoding if the inputs can simply be joined together. The
+    # chapters of a book that was (or would be) built that way are marked
+    # with the lengths of the copied packets, so an update keeps them.
+    output = OutputSpec(output_filename, bit_rate=args.bitrate)
+    copyable = not args.single_pass and (
+        bool(segments) or
+        not args.no_copy and output.format == 'mp4' and
+        output.codec == 'aac' and not output.bit_rate and
+        can_stream_copy(chapters, pcm_format))
+    stream_copy = copyable and not update_only
+    file_duration = stream_copy_duration if copyable \
+        else lambda info: info.duration
+
+    # --engine concat has one ffmpeg open every input at once, so a book
+    # with more of them than it's allowed goes through the pipe instead
+    engine = args.engine
+    if engine == 'concat' and not stream_copy and not update_only and \
+            not can_open_files(
+                sum(len(chapter['files']) for chapter in chapters)):
+        eprint('Warning: too many input files for --engine concat to open '
+               'at once, using --engine pipe')
+        engine = 'pipe'
 
     # Write the metadata file with the chapters and stuff
     ffmetadata_fd, ffmetadata_filename = make_temporary_filename(
-        args.output_filename, '.txt')
+        output_filename, '.txt')
     try:
         with os.fdopen(ffmetadata_fd, 'w') as ffmetadata_file:
-            write_metadata_file(
-                metadata,
-                chapters,
-                ffmetadata_file)
-
-        # Write the merged file
-        if args.update_only and os.path.isfile(args.output_filename):
-            update_audio_file(
-                ffmetadata_filename,
-                manifest.album_art,
-                args.output_filename)
-        else:
-            write_merged_audio_file(
-                chapters,
-                ffmetadata_filename,
-                manifest.album_art,
-                args.output_filename)
+            # with --single-pass the chapters aren't known until the end
+            if not args.single_pass:
+                with profiler.stage('write metadata'):
+                    write_metadata_file(
+                        metadata,
+                        chapters,
+                        ffmetadata_file,
+                        file_duration)
+
+        # the exact length of each file's decoded audio, from the engines
+        # that have to count it anyway
+        result = {}
+        with profiler.stage('write output'):
+            # Write the merged file
+            if update_only and os.path.isfile(output_filename):
+                # rewrite the metadata in place if possible, and remux if not
+                marks = list(chapter_marks(chapters, file_duration))
+                for file_name in [output_filename,
+                                  *(v.file_name for v in args.variants)]:
+                    if not os.path.isfile(file_name):
+                        continue
+                    if OutputSpec(file_name).format != 'mp4' or \
+                            not update_mp4_in_place(
+                                file_name,
+                                metadata,
+                                marks,
+                                manifest.album_art):
+                        update_audio_file(
+                            ffmetadata_filename,
+                            manifest.album_art,
+                            file_name)
+            elif args.single_pass:
+                # with --scratch-dir, the files are kept there until they've
+                # been remuxed, so they're only written to the output once
+                file_names = [output_filename,
+                              *(v.file_name for v in args.variants)]
+                staged_filenames = file_names
+                if scratch.dir:
+                    staged_filenames = []
+                    for file_name in file_names:
+                        fd, staged_filename = make_temporary_filename(
+                            file_name)
+                        os.close(fd)
+                        staged_filenames.append(staged_filename)
+                try:
+                    result = write_merged_audio_file(
+                        chapters,
+                        None,
+                        None,
+                        staged_filenames[0],
+                        args.prefetch,
+                        args.buffer_size,
+                        pcm_format=pcm_format,
+                        bit_rate=args.bitrate,
+                        variants=[
+                            OutputSpec(file_name, v.codec, v.bit_rate)
+                            for v, file_name
+                            in zip(args.variants, staged_filenames[1:])])
+
+                    # now that the files' lengths are known, add the chapters,
+                    # tags and art with a quick remux
+                    file_samples = iter(result['file_samples'])
+                    for chapter in chapters:
+                        for info in chapter['files']:
+                            info.duration = next(file_samples) / pcm_format.sample_rate
+                    with open(ffmetadata_filename, 'w') as ffmetadata_file:
+                        write_metadata_file(metadata, chapters, ffmetadata_file)
+                    for file_name in staged_filenames:
+                        update_audio_file(
+                            ffmetadata_filename,
+                            manifest.album_art,
+                            file_name)
+
+                    if scratch.dir:
+                        for staged_filename, file_name in zip(
+                                staged_filenames, file_names):
+                            scratch.commit(staged_filename, file_name)
+                except BaseException:
+                    if scratch.dir:
+                        for staged_filename in staged_filenames:
+                            if os.path.exists(staged_filename):
+                                delete_temporary_file(staged_filename)
+                    raise
+            elif engine == 'sharded' and not stream_copy:
+                result = write_sharded_audio_file(
+                    chapters,
+                    ffmetadata_filename,
+                    manifest.album_art,
+                    output_filename,
+                    args.shards,
+                    args.jobs,
+                    pcm_format,
+                    resume_work_dir(args, output_filename)
+                    if args.resume else None)
+            elif engine == 'concat' and not stream_copy:
+                write_concatenated_audio_file(
+                    chapters,
+                    ffmetadata_filename,
+                    manifest.album_art,
+                    output_filename,
+                    pcm_format)
+            else:
+                result = write_merged_audio_file(
+                    chapters,
+                    ffmetadata_filename,
+                    manifest.album_art,
+                    output_filename,
+                    args.prefetch,
+                    args.buffer_size,
+                    stream_copy,
+                    pcm_format,
+                    args.bitrate,
+                    args.variants)
+
+        duration = sum(
+            file_duration(info)
+            for chapter in chapters for info in chapter['files'])
+        profiler.add_audio(duration)
+
+        if args.verify:
+            with profiler.stage('verify output'):
+                # the probed lengths of the files can be a frame or two off
+                # what they decode to, so the output is checked against the
+                # exact lengths, counting them if the engine didn't
+                file_samples = result.get('file_samples')
+                if file_samples is None and not copyable:
+                    file_samples = count_chapter_samples(
+                        chapters, pcm_format, args.jobs)
+                expected_duration = duration if file_samples is None \
+                    else sum(file_samples) / pcm_format.sample_rate
+                for file_name in [output_filename,
+                                  *(v.file_name for v in args.variants)]:
+                    if os.path.isfile(file_name):
+                        verify_audio_file(file_name, expected_duration)
+
+        if segments:
+            segments.record_output(output_filename, audio_key)
     finally:
         delete_temporary_file(ffmetadata_filename)
+        if segments:
+            segments.close()
+
+
+# The time of the first audio packet and how long each lasts, in seconds. The
+# length is None if the file doesn't say.
+def probe_packets(file_name):
+    output, _ = run_custom(['ffprobe',
+                            '-v', 'error',
+                            '-select_streams', 'a:0',
+                            '-show_entries',
+                            'stream=time_base:packet=pts,duration',
+                            '-read_intervals', '%+#1',
+                            '-of', 'json',
+                            '-i', file_name])
+    probe = json.loads(output)
+    streams = probe.get('streams', [])
+    packets = probe.get('packets', [])
+    if not streams or not packets or 'pts' not in packets[0] or \
+            not packets[0].get('duration'):
+        return 0, None
+    time_base = Fraction(streams[0]['time_base'])
+    return packets[0]['pts'] * time_base, packets[0]['duration'] * time_base
+
+
+# Where to cut the chapters out of a book, as (start, end, title) with times
+# in seconds and None for the start or end of the book. Each chapter runs up
+# to the start of the next, moved to the nearest packet boundary, so every
+# packet ends up in exactly one chapter. As ffmpeg keeps the packets from -ss
+# up to -to, the cuts are made half a packet early to be clear of rounding.
+def split_points(chapters, first_packet, packet_duration):
+    def cut(time):
+        if not packet_duration:
+            return time
+        packets = round((Fraction(time) - first_packet) / packet_duration)
+        return float(first_packet +
+                     (packets - Fraction(1, 2)) * packet_duration)
+
+    starts = [None] + [cut(start) for start, _, _ in chapters[1:]]
+    return [(start, end, title) for start, end, (_, _, title)
+            in zip(starts, starts[1:] + [None], chapters)]
+
+
+# copies the cover out of a book into art_filename, if it has one
+def extract_album_art(file_name, art_filename):
+    output, _ = run_custom(['ffprobe',
+                            '-v', 'error',
+                            '-select_streams', 'v',
+                            '-show_entries',
+                            'stream=index:stream_disposition=attached_pic',
+                            '-of', 'json',
+                            '-i', file_name])
+    pictures = [stream['index']
+                for stream in json.loads(output).get('streams', [])
+                if stream.get('disposition', {}).get('attached_pic')]
+    if not pictures:
+        return False
+
+    art_cmd = FFmpegCommandLine(art_filename, format='image2', overwrite=True)
+    art_cmd.add_file(file_name, map=True, stream_index=pictures[0])
+    art_cmd.add_args('-vcodec', 'copy', '-frames:v', 1)
+    run_custom(art_cmd.get_cmdline(), capture_stdout=False, watch=False)
+    return True
+
+
+# where --split puts the chapters of a book
+def split_output_dir(args, book_filename):
+    return os.path.join(args.output_dir or os.path.dirname(book_filename),
+                        Path(book_filename).stem)
+
+
+# Writes each chapter of a book to its own file in output_dir, tagged as a
+# track of the book and named after it. The chapters are cut out of the book
+# with stream copy, several at once.
+def split_audiobook(args, book_filename, output_dir, cache=None):
+    # progress events say which book they're for
+    progress_events.context.book = book_filename
+
+    with profiler.stage('analyze files'):
+        info = probe_file(book_filename, cache)
+        if not info.chapters:
+            raise RuntimeError(f'No chapters in "{book_filename}"')
+        first_packet, packet_duration = probe_packets(book_filename)
+    cuts = split_points(info.chapters, first_packet, packet_duration)
+
+    title = info.tags.get('album') or info.tags.get('title') or \
+        Path(book_filename).stem
+    output_format = OutputSpec(book_filename).format
+    suffix = Path(book_filename).suffix
+    width = max(len(str(len(cuts))), 2)
+
+    os.makedirs(output_dir, exist_ok=True)
+    _, art_filename = make_temporary_filename(
+        os.path.join(output_dir, Path(book_filename).stem), '.art')
+    try:
+        has_album_art = extract_album_art(book_filename, art_filename)
+    except BaseException:
+        delete_temporary_file(art_filename)
+        raise
+
+    def split_chapter(index):
+        start, end, name = cuts[index]
+        number = f'{index + 1:0{width}d}'
+        escaped_name = escape_filename(name)
+        output_filename = os.path.join(
+            output_dir,
+            f'{number} {escaped_name}{suffix}' if escaped_name
+            else f'{number}{suffix}')
+
+        metadata = merge_metadata(info.tags, {
+            'title': name or number,
+            'album': title,
+            'track': f'{index + 1}/{len(cuts)}',
+        })
+        ffmetadata_fd, ffmetadata_filename = make_temporary_filename(
+            output_filename, '.txt')
+        _, temp_filename = make_temporary_filename(output_filename)
+        try:
+            with os.fdopen(ffmetadata_fd, 'w') as ffmetadata_file:
+                write_metadata_file(metadata, [], ffmetadata_file)
+
+            # seek to a little before the cut, then keep the book's own
+            # timestamps so that -ss and -to are on the same timeline
+            cut_cmd = FFmpegCommandLine(format=output_format)
+            pre_input_args = ['-copyts']
+            if start is not None:
+                pre_input_args[:0] = ['-ss', str(max(start - 1, 0))]
+            cut_cmd.add_file(book_filename, True, 'a:0', pre_input_args)
+            metadata_index = cut_cmd.add_metadata_file(ffmetadata_filename)
+            if output_format == 'ogg':
+                # Ogg keeps its tags with the stream rather than the file
+                cut_cmd.add_args('-map_metadata:s:a', f'{metadata_index}:g')
+            if start is not None:
+                cut_cmd.add_args(
+                    '-ss', start, '-avoid_negative_ts', 'make_zero')
+            if end is not None:
+                cut_cmd.add_args('-to', end)
+            cut_cmd.add_args('-acodec', 'copy')
+            cut_cmd.set_output(temp_filename, True)
+            # the cut prints nothing as it goes, so it can't be judged stalled
+            # by its output
+            run_custom(cut_cmd.get_cmdline(), capture_stdout=False,
+                       watch=False)
+
+            # the cover would be cut off with the audio before -ss, so it's
+            # added afterwards
+            if has_album_art and output_format in ALBUM_ART_FORMATS and (
+                    output_format != 'mp4' or not update_mp4_in_place(
+                        temp_filename, metadata, [], art_filename)):
+                update_audio_file(
+                    ffmetadata_filename, art_filename, temp_filename)
+
+            scratch.commit(temp_filename, output_filename)
+        except BaseException:
+            delete_temporary_file(temp_filename)
+            raise
+        finally:
+            delete_temporary_file(ffmetadata_filename)
+        return output_filename
+
+    try:
+        with profiler.stage('split chapters'), \
+                progress_bar('split', len(cuts), unit='chapter') as pbar, \
+                ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [executor.submit(split_chapter, index)
+                       for index in range(len(cuts))]
+            try:
+                for future in as_completed(futures):
+                    pbar.set_file('Wrote', future.result())
+                    pbar.update(1)
+            except BaseException:
+                # don't start any more cuts; the running ones finish quickly
+                executor.shutdown(wait=True, cancel_futures=True)
+                raise
+    finally:
+        delete_temporary_file(art_filename)
+
+    profiler.add_audio(info.duration)
+
+
+# the SHA-256 of a file, read from start to end in large blocks
+def sha256_file(file_name):
+    digest = hashlib.sha256()
+    buffer = bytearray(CHECKSUM_READ_SIZE)
+    view = memoryview(buffer)
+    with open(file_name, 'rb', buffering=0) as file:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while size := file.readinto(buffer):
+            # hashlib lets go of the GIL for this, so threads hash in parallel
+            digest.update(view[:size])
+    return digest.hexdigest()
+
+
+# the SHA-256 of a file, from the cache if it hasn't changed since
+def file_checksum(file_name, cache=None):
+    if cache:
+        record = cache.get(file_name)
+        if record and 'sha256' in record:
+            return record['sha256']
+
+    checksum = sha256_file(file_name)
+
+    if cache:
+        cache.update(file_name, {'sha256': checksum})
+    return checksum
+
+
+# A line of sha256sum's output. Names with a backslash or newline in them are
+# escaped, and the line starts with a backslash to say so.
+def checksum_line(checksum, file_name):
+    if '\\' in file_name or '\n' in file_name:
+        file_name = file_name.replace('\\', '\\\\').replace('\n', '\\n')
+        return f'\\{checksum}  {file_name}'
+    return f'{checksum}  {file_name}'
+
+
+# the files under a directory, not following symlinks (like find -type f)
+def _walk_files(path):
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk_files(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path
+
+
+# Writes the SHA-256 of each file given, and of every file under each
+# directory given, to stdout in sha256sum's format and sorted by name. Files
+# that can't be read are reported and skipped. Returns whether all of them
+# could be.
+def write_checksums(paths, jobs=None, cache=None):
+    file_names = []
+    for path in paths:
+        if os.path.isdir(path):
+            file_names.extend(_walk_files(path))
+        else:
+            file_names.append(path)
+    file_names.sort()
+
+    ok = True
+    with progress_bar('checksum', len(file_names)) as pbar, \
+            ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(file_checksum, file_name, cache)
+                   for file_name in file_names]
+        try:
+            # in order, so the output is the same however the hashing goes
+            for file_name, future in zip(file_names, futures):
+                pbar.set_file('Hashing', file_name)
+                try:
+                    checksum = future.result()
+                except OSError as e:
+                    eprint(f'{file_name}: {e.strerror or e}')
+                    ok = False
+                else:
+                    sys.stdout.write(
+                        f'{checksum_line(checksum, file_name)}\n')
+                pbar.update(1)
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+    sys.stdout.flush()
+    return ok
+
+
+# Finds the manifests to merge with --batch: the files given, and the
+# manifests in any directories given
+def find_batch_manifests(paths):
+    manifests = []
+    for path in paths:
+        if not os.path.isdir(path):
+            manifests.append(path)
+            continue
+        with os.scandir(path) as it:
+            manifests.extend(sorted(
+                entry.path for entry in it
+                if entry.is_file() and
+                entry.name.lower().endswith(BATCH_MANIFEST_EXTENSIONS)))
+    return manifests
+
+
+# Guesses how long a book is without running ffprobe: cached durations are
+# used where there are any, and file sizes otherwise
+def estimate_book_duration(manifest, cache=None):
+    duration = 0
+    for file_name in manifest.files:
+        record = cache.get(file_name) if cache else None
+        if record and 'probe' in record:
+            duration += record['probe']['duration']
+        else:
+            try:
+                duration += os.path.getsize(file_name) * 8 / ESTIMATED_BIT_RATE
+            except OSError:
+                pass
+    return duration
+
+
+# The ffmpeg processes and decoded audio a book needs while it's merged
+def book_cost(args):
+    if args.engine == 'concat':
+        processes, memory = 1, 0
+    elif args.engine == 'sharded':
+        processes, memory = args.shards + 1, 0
+    else:
+        processes, memory = args.prefetch + 2, args.buffer_size
+    # files are analyzed before merging, so that can be as busy
+    return max(processes, args.jobs), memory
+
+
+# Limits how many processes and how much memory books running at the same
+# time can use between them
+class ResourceBudget:
+    def __init__(self, max_processes, max_memory):
+        self._max_processes = max_processes
+        self._max_memory = max_memory
+        self._processes = 0
+        self._memory = 0
+        self._condition = threading.Condition()
+
+    # a book that needs more than the whole budget gets all of it
+    def _clamp(self, processes, memory):
+        return min(processes, self._max_processes), \
+            min(memory, self._max_memory)
+
+    def acquire(self, processes, memory):
+        processes, memory = self._clamp(processes, memory)
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._processes + processes <= self._max_processes and
+                self._memory + memory <= self._max_memory)
+            self._processes += processes
+            self._memory += memory
+
+    def release(self, processes, memory):
+        processes, memory = self._clamp(processes, memory)
+        with self._condition:
+            self._processes -= processes
+            self._memory -= memory
+            self._condition.notify_all()
+
+
+def _batch_output_filename(args, manifest_filename):
+    return os.path.join(
+        args.output_dir or os.path.dirname(manifest_filename),
+        f'{Path(manifest_filename).stem}.m4b')
+
+
+# Reads a book's manifest for --batch. Returns the book's result so far, and
+# the manifest, or None if it couldn't be read.
+def prepare_book(args, manifest_filename, cache=None):
+    book = {
+        'manifest': manifest_filename,
+        'output': _batch_output_filename(args, manifest_filename),
+        'status': 'failed',
+        'error': None,
+        'estimated_duration': 0,
+        'seconds': 0,
+    }
+    try:
+        manifest = read_manifests(
+            [manifest_filename],
+            args.root_dir or os.path.dirname(manifest_filename))
+        book['estimated_duration'] = estimate_book_duration(manifest, cache)
+    except Exception as e:
+        book['error'] = str(e)
+        manifest = None
+    return book, manifest
+
+
+# Runs books in the background, as many at once as the budget allows. Of the
+# books waiting, the longest starts first, so that the last few to finish
+# are short ones.
+class BookScheduler:
+    def __init__(self, args, cache=None, on_start=None, on_done=None):
+        self._cache = cache
+        self._on_start = on_start
+        self._on_done = on_done
+        self._budget = ResourceBudget(args.max_processes, args.max_memory)
+        # each book gets its own copy of the options, with its analysis
+        # limited to its share of the budget
+        self._book_args = argparse.Namespace(**vars(args))
+        self._book_args.jobs = min(args.jobs, args.max_processes)
+        self._cost = book_cost(self._book_args)
+
+        # every book needs at least one process, so this is never the limit
+        self._executor = ThreadPoolExecutor(max_workers=args.max_processes)
+        self._waiting = queue.PriorityQueue()
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._cancelled = False
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def _dispatch(self):
+        while True:
+            _, _, job = self._waiting.get()
+            if job is None:
+                break
+            self._budget.acquire(*self._cost)
+            # the scheduler may have been cancelled while this waited for
+            # a running book to finish
+            with self._lock:
+                if self._cancelled:
+                    self._budget.release(*self._cost)
+                    break
+                self._executor.submit(job)
+
+    def _put(self, priority, job):
+        with self._lock:
+            self._sequence += 1
+            self._waiting.put((priority, self._sequence, job))
+
+    def _merge(self, book, manifest):
+        if self._on_start:
+            self._on_start(book)
+        start_time = time.monotonic()
+        try:
+            merge_audiobook(self._book_args, manifest, [book['manifest']],
+                            book['output'], self._cache)
+            book['status'] = 'ok'
+        except Exception as e:
+            book['error'] = str(e)
+        finally:
+            book['seconds'] = time.monotonic() - start_time
+            self._budget.release(*self._cost)
+        if progress_events.enabled:
+            progress_events.emit({'event': 'book', 'time': time.time(), **book})
+        else:
+            tqdm.write(f'{book["status"]}: {book["output"]} '
+                       f'({book["seconds"]:.1f}s)', file=sys.stderr)
+        if self._on_done:
+            self._on_done(book)
+
+    def submit(self, book, manifest):
+        self._put(-book['estimated_duration'],
+                  lambda: self._merge(book, manifest))
+
+    # waits for the books that have been submitted, or if cancelled, only
+    # those that have already started
+    def close(self, cancel=False):
+        if cancel:
+            with self._lock:
+                self._cancelled = True
+        self._put(float('-inf') if cancel else float('inf'), None)
+        self._dispatcher.join()
+        self._executor.shutdown(wait=True, cancel_futures=cancel)
+
+
+# Merges each manifest into its own book. Returns a result for each book.
+def merge_batch(args, cache=None):
+    books = []
+    output_filenames = set()
+    for manifest_filename in find_batch_manifests(args.input_filenames):
+        book, manifest = prepare_book(args, manifest_filename, cache)
+        if book['output'] in output_filenames:
+            raise RuntimeError(
+                f'More than one manifest would be written to "{book["output"]}"')
+        output_filenames.add(book['output'])
+        books.append((book, manifest))
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    scheduler = BookScheduler(args, cache)
+    try:
+        for book, manifest in sorted(
+                books, key=lambda x: x[0]['estimated_duration'], reverse=True):
+            if manifest:
+                scheduler.submit(book, manifest)
+    except BaseException:
+        scheduler.close(cancel=True)
+        raise
+    scheduler.close()
+
+    return [book for book, _ in books]
+
+
+def write_batch_report(books, report_filename=None):
+    failed = [book for book in books if book['status'] != 'ok']
+    for book in failed:
+        eprint(f'Failed: {book["manifest"]}\n{book["error"]}')
+    eprint(f'{len(books) - len(failed)} of {len(books)} books merged '
+           f'in {sum(book["seconds"] for book in books):.1f}s of work')
+
+    if report_filename:
+        with open(report_filename, 'w', encoding='utf-8') as report_file:
+            json.dump({'books': books}, report_file, indent=2)
+
+
+# Wakes up when something changes in the inbox directories, using inotify
+# where it's available and polling where it isn't
+class InboxWatcher:
+    _EVENTS = (INOTIFY_CLOSE_WRITE | INOTIFY_MOVED_FROM | INOTIFY_MOVED_TO |
+               INOTIFY_CREATE | INOTIFY_DELETE)
+
+    def __init__(self, directories, poll_interval):
+        self._poll_interval = poll_interval
+        self._fd = None
+        self._directories = {}
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (AttributeError, OSError, TypeError):
+            return
+        if fd < 0:
+            return
+        self._fd = fd
+        for directory in directories:
+            for path, _, _ in os.walk(directory):
+                self._watch(path)
+
+    @property
+    def polling(self):
+        return self._fd is None
+
+    def _watch(self, directory):
+        wd = self._add_watch(self._fd, os.fsencode(directory), self._EVENTS)
+        if wd >= 0:
+            self._directories[wd] = directory
+
+    # Waits for changes. Returns the paths that changed, or None if anything
+    # could have.
+    def wait(self, timeout):
+        if self.polling:
+            time.sleep(min(timeout, self._poll_interval))
+            return None
+
+        changed = set()
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return changed
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, size = struct.unpack_from('iIII', data, offset)
+            offset += struct.calcsize('iIII')
+            name = os.fsdecode(data[offset:offset + size].rstrip(b'\0'))
+            offset += size
+            if mask & INOTIFY_Q_OVERFLOW or wd not in self._directories:
+                return None
+            path = os.path.join(self._directories[wd], name)
+            # watch new folders too, since books' files are often in them
+            if mask & INOTIFY_ISDIR and mask & (INOTIFY_CREATE |
+                                                INOTIFY_MOVED_TO):
+                for subdirectory, _, _ in os.walk(path):
+                    self._watch(subdirectory)
+            changed.add(path)
+        return changed
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+# Identifies a book by the size and modification time of its manifest and
+# every file it names. Returns None if the manifest can't be read or any of
+# the files are missing.
+def book_fingerprint(args, manifest_filename):
+    try:
+        manifest = read_manifests(
+            [manifest_filename],
+            args.root_dir or os.path.dirname(manifest_filename))
+        files = [manifest_filename, *manifest.files]
+        if manifest.album_art:
+            files.append(manifest.album_art)
+        fingerprint = []
+        for file_name in files:
+            st = os.stat(file_name)
+            fingerprint.append((file_name, st.st_size, st.st_mtime_ns))
+        return tuple(fingerprint)
+    except Exception:
+        return None
+
+
+# whether the output was written after every file in the book last changed
+def _is_up_to_date(output_filename, fingerprint):
+    try:
+        output_mtime_ns = os.stat(output_filename).st_mtime_ns
+    except OSError:
+        return False
+    return all(output_mtime_ns >= mtime_ns for _, _, mtime_ns in fingerprint)
+
+
+# Keeps the status of --watch in a JSON file, for other programs to monitor
+class WatchStatus:
+    def __init__(self, status_filename):
+        self._status_filename = status_filename
+        self._lock = threading.Lock()
+        self._status = {
+            'started': time.time(),
+            'updated': time.time(),
+            'settling': 0,
+            'queued': 0,
+            'running': 0,
+            'completed': 0,
+            'failed': 0,
+            'audio_seconds': 0,
+            'books_per_hour': 0,
+            'recent': [],
+        }
+
+    def set_settling(self, settling):
+        with self._lock:
+            if self._status['settling'] != settling:
+                self._status['settling'] = settling
+                self._write()
+
+    def book_queued(self):
+        with self._lock:
+            self._status['queued'] += 1
+            self._write()
+
+    def book_started(self, book):
+        with self._lock:
+            self._status['queued'] -= 1
+            self._status['running'] += 1
+            self._write()
+
+    def book_done(self, book, started=True):
+        with self._lock:
+            status = self._status
+            if started:
+                status['running'] -= 1
+            else:
+                status['queued'] -= 1
+            if book['status'] == 'ok':
+                status['completed'] += 1
+                status['audio_seconds'] += book['estimated_duration']
+            else:
+                status['failed'] += 1
+            hours = max(time.time() - status['started'], 1) / 3600
+            status['books_per_hour'] = status['completed'] / hours
+            status['recent'] = [book, *status['recent']][:WATCH_RECENT_BOOKS]
+            self._write()
+
+    def _write(self):
+        self._status['updated'] = time.time()
+        if not self._status_filename:
+            return
+        fd, temp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(self._status_filename), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as status_file:
+                json.dump(self._status, status_file, indent=2)
+            os.replace(temp_filename, self._status_filename)
+        except Exception as e:
+            delete_temporary_file(temp_filename)
+            eprint(f'Warning: couldn\'t write status to '
+                   f'"{self._status_filename}": {e}')
+
+
+# Merges books as their manifests land in the inbox directories, once they
+# and the files they name have stopped changing for --settle seconds. Runs
+# until interrupted.
+def watch_inboxes(args, cache=None):
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    status = WatchStatus(args.status_file)
+    # books that are queued or running, which aren't queued again until done
+    active = set()
+    active_lock = threading.Lock()
+
+    def on_done(book, started=True):
+        with active_lock:
+            active.discard(book['manifest'])
+        status.book_done(book, started)
+        # the cache isn't pruned at exit, as this never exits normally
+        if cache:
+            cache.prune()
+
+    scheduler = BookScheduler(args, cache, status.book_started, on_done)
+    # stop the same way when run as a service
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    watcher = InboxWatcher(args.input_filenames, args.poll_interval)
+    if watcher.polling:
+        eprint(f'Polling for changes every {args.poll_interval}s')
+
+    # for each manifest: its fingerprint, when that last changed, and the
+    # fingerprint it was last merged (or found to be up to date) with
+    books = {}
+    changed = None
+    try:
+        while True:
+            now = time.monotonic()
+            manifests = find_batch_manifests(args.input_filenames)
+            for manifest_filename in list(books):
+                if manifest_filename not in manifests:
+                    del books[manifest_filename]
+
+            for manifest_filename in manifests:
+                state = books.get(manifest_filename)
+                if state is None:
+                    state = books[manifest_filename] = {
+                        'fingerprint': None, 'since': now, 'merged': None}
+                elif changed is not None and \
+                        state['fingerprint'] == state['merged'] and \
+                        manifest_filename not in changed and \
+                        not any(not path.endswith(BATCH_MANIFEST_EXTENSIONS)
+                                for path in changed):
+                    # nothing it could depend on has changed
+                    continue
+                fingerprint = book_fingerprint(args, manifest_filename)
+                if fingerprint != state['fingerprint']:
+                    state['fingerprint'] = fingerprint
+                    state['since'] = now
+
+            settling = 0
+            for manifest_filename, state in books.items():
+                fingerprint = state['fingerprint']
+                if fingerprint is None or fingerprint == state['merged']:
+                    continue
+                with active_lock:
+                    if manifest_filename in active or \
+                            now - state['since'] < args.settle:
+                        settling += 1
+                        continue
+                    state['merged'] = fingerprint
+                    if _is_up_to_date(_batch_output_filename(
+                            args, manifest_filename), fingerprint):
+                        continue
+                    active.add(manifest_filename)
+
+                status.book_queued()
+                book, manifest = prepare_book(args, manifest_filename, cache)
+                if manifest:
+                    scheduler.submit(book, manifest)
+                else:
+                    on_done(book, started=False)
+            status.set_settling(settling)
+
+            changed = watcher.wait(args.settle / 2)
+    except KeyboardInterrupt:
+        eprint('Stopping once the books that have started are done')
+    finally:
+        watcher.close()
+        scheduler.close(cancel=True)
+
+
+if __name__ == '__main__':
+    # parse command line
+    args = parse_command_line()
+
+    if args.profile:
+        profiler.enable()
+    supervisor.stall_timeout = args.stall_timeout
+    scratch.dir = args.scratch_dir
+    if args.progress_format == 'jsonl':
+        progress_events.open(args.progress_fd)
+
+    # Open the cache of file analysis from previous runs
+    cache = ProbeCache(args.cache_dir) if not args.no_cache else None
+
+    try:
+        if args.watch:
+            watch_inboxes(args, cache)
+        elif args.checksum:
+            if not write_checksums(args.input_filenames, args.jobs, cache):
+                sys.exit(1)
+        elif args.split:
+            for book_filename in args.input_filenames:
+                split_audiobook(args, book_filename,
+                                split_output_dir(args, book_filename), cache)
+        elif args.batch:
+            books = merge_batch(args, cache)
+            write_batch_report(books, args.report)
+            if any(book['status'] != 'ok' for book in books):
+                sys.exit(1)
+        else:
+            # set the current working directory to the directory of the input
+            # file so that relative paths work correctly
+            os.chdir(args.root_dir)
+
+            # Read the manifest(s)
+            manifest = read_manifests(
+                args.input_filenames, cache=cache, jobs=args.jobs)
+
+            merge_audiobook(args, manifest, args.input_filenames,
+                            args.output_filename, cache)
+    finally:
+        if cache:
+            cache.prune()
+        if args.profile:
+            profiler.write_report(args.profile)
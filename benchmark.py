@@ -0,0 +1,396 @@
+#!/usr/bin/python3
+# Times the stages of a merge on synthetic audiobooks, so that a change can
+# be measured by running this before and after it and comparing the results.
+#
+#   ./benchmark.py -o before.json
+#   ./benchmark.py -o after.json --shapes ten-chapters-mp3 few-long-mp3
+#   ./benchmark.py -o parser.json --parser
+#
+# The books are generated with ffmpeg's lavfi sources the first time they're
+# needed, and kept in --work-dir for later runs. With --parser, only the
+# parsing of manifests of increasing size is timed.
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+MERGER_FILENAME = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'audiobook-merger.py')
+
+# files: how many input files; seconds: how long each one is;
+# files_per_chapter: how the files are grouped into chapters
+SHAPES = {
+    'many-short-mp3': {
+        'files': 1000, 'seconds': 2, 'channels': 2, 'codec': 'mp3',
+        'files_per_chapter': 1,
+    },
+    'many-short-m4a': {
+        'files': 1000, 'seconds': 2, 'channels': 2, 'codec': 'm4a',
+        'files_per_chapter': 1,
+    },
+    'few-long-mp3': {
+        'files': 3, 'seconds': 1200, 'channels': 2, 'codec': 'mp3',
+        'files_per_chapter': 1,
+    },
+    'few-long-m4a': {
+        'files': 3, 'seconds': 1200, 'channels': 2, 'codec': 'm4a',
+        'files_per_chapter': 1,
+    },
+    'ten-chapters-mp3': {
+        'files': 100, 'seconds': 30, 'channels': 2, 'codec': 'mp3',
+        'files_per_chapter': 10,
+    },
+    'mono-mp3': {
+        'files': 20, 'seconds': 60, 'channels': 1, 'codec': 'mp3',
+        'files_per_chapter': 1,
+    },
+    'stereo-mp3': {
+        'files': 20, 'seconds': 60, 'channels': 2, 'codec': 'mp3',
+        'files_per_chapter': 1,
+    },
+}
+STAGES = ('probe', 'merge', 'update')
+CODEC_ARGS = {
+    'mp3': ('-acodec', 'libmp3lame', '-b:a', '64k'),
+    'm4a': ('-acodec', 'aac', '-b:a', '64k'),
+}
+# the number of files in the manifests timed with --parser
+PARSER_FILES = (1000, 10000, 100000)
+MANIFEST_FORMATS = ('csv', 'txt')
+
+
+def load_merger():
+    spec = importlib.util.spec_from_file_location(
+        'audiobook_merger', MERGER_FILENAME)
+    merger = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(merger)
+    return merger
+
+
+def _book_dir(work_dir, shape_name, scale):
+    return os.path.join(work_dir, f'{shape_name}-x{scale:g}')
+
+
+# Writes the shape's files and a manifest for them, unless they're already
+# there. The audio is a tone with a little noise, so that it's deterministic
+# but not trivial to encode.
+def generate_book(work_dir, shape_name, scale):
+    shape = SHAPES[shape_name]
+    book_dir = _book_dir(work_dir, shape_name, scale)
+    manifest_filename = os.path.join(book_dir, 'book.csv')
+    if os.path.isfile(manifest_filename):
+        return manifest_filename
+
+    shutil.rmtree(book_dir, ignore_errors=True)
+    os.makedirs(book_dir)
+    seconds = max(shape['seconds'] * scale, 0.1)
+    sample_rate = 44100
+    subprocess.run([
+        'ffmpeg', '-v', 'error',
+        '-f', 'lavfi', '-i',
+        f'sine=frequency=220:sample_rate={sample_rate}:'
+        f'duration={shape["files"] * seconds}',
+        '-f', 'lavfi', '-i',
+        f'anoisesrc=color=pink:amplitude=0.05:seed=1:'
+        f'sample_rate={sample_rate}',
+        '-filter_complex', 'amix=inputs=2:duration=first',
+        '-ac', str(shape['channels']),
+        *CODEC_ARGS[shape['codec']],
+        '-f', 'segment', '-segment_time', str(seconds),
+        os.path.join(book_dir, f'%05d.{shape["codec"]}'),
+    ], check=True)
+
+    # segments are cut on frame boundaries, which can leave a sliver of
+    # audio in an extra file at the end
+    files = sorted(f for f in os.listdir(book_dir)
+                   if f.endswith(f'.{shape["codec"]}'))
+    for file_name in files[shape['files']:]:
+        os.remove(os.path.join(book_dir, file_name))
+    files = files[:shape['files']]
+
+    # the manifest is written last, so an interrupted book is regenerated
+    with open(manifest_filename + '.tmp', 'w', encoding='utf-8') as manifest:
+        for index, file_name in enumerate(files):
+            chapter = index // shape['files_per_chapter'] + 1
+            manifest.write(f'{file_name},Chapter {chapter}\n')
+    os.replace(manifest_filename + '.tmp', manifest_filename)
+    return manifest_filename
+
+
+# Runs one stage of a merge in this process and returns its measurements.
+# Each stage runs in a new process so that its peak memory use is its own.
+def run_stage(stage, manifest_filename, state_filename):
+    merger = load_merger()
+    book_dir = os.path.dirname(manifest_filename)
+    output_filename = os.path.join(book_dir, 'output.m4b')
+    os.chdir(book_dir)
+
+    manifest = merger.read_manifests([manifest_filename])
+    if stage != 'probe':
+        with open(state_filename, 'r', encoding='utf-8') as state_file:
+            chapters = [
+                {'name': c['name'],
+                 'files': [merger.AudioFileInfo.from_dict(f, d)
+                           for f, d in c['files']]}
+                for c in json.load(state_file)
+            ]
+        metadata_fd, metadata_filename = merger.make_temporary_filename(
+            output_filename, '.txt')
+        with os.fdopen(metadata_fd, 'w') as metadata_file:
+            merger.write_metadata_file(
+                {'title': 'Benchmark'}, chapters, metadata_file)
+
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_time = time.perf_counter()
+    bytes_piped = 0
+
+    if stage == 'probe':
+        chapters = merger.get_chapter_metadata(manifest.chapters)
+    elif stage == 'merge':
+        result = merger.write_merged_audio_file(
+            chapters, metadata_filename, None, output_filename)
+        bytes_piped = result['bytes_forwarded']
+    else:
+        merger.update_audio_file(metadata_filename, None, output_filename)
+
+    wall = time.perf_counter() - start_time
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    if stage == 'probe':
+        with open(state_filename, 'w', encoding='utf-8') as state_file:
+            json.dump([
+                {'name': c['name'],
+                 'files': [(i.file_name, i.to_dict()) for i in c['files']]}
+                for c in chapters
+            ], state_file)
+    else:
+        merger.delete_temporary_file(metadata_filename)
+
+    def cpu(before, after):
+        return (after.ru_utime - before.ru_utime) + \
+            (after.ru_stime - before.ru_stime)
+
+    # ru_maxrss is in KiB on Linux and bytes on macOS. A child's peak counts
+    # the memory it shared with this process between fork and exec, so the
+    # children's peak is never less than this process's was.
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'wall_seconds': wall,
+        'cpu_seconds': cpu(self_before, self_after),
+        'children_cpu_seconds': cpu(children_before, children_after),
+        'peak_rss_bytes': self_after.ru_maxrss * rss_unit,
+        'children_peak_rss_bytes': children_after.ru_maxrss * rss_unit,
+        'bytes_piped': bytes_piped,
+        'audio_seconds': sum(
+            i.duration for c in chapters for i in c['files']),
+    }
+
+
+def _run_stage_process(stage, manifest_filename, state_filename, verbose):
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__),
+         '--stage', stage, manifest_filename, state_filename],
+        stdout=subprocess.PIPE,
+        stderr=None if verbose else subprocess.PIPE,
+        check=False)
+    if process.returncode:
+        raise RuntimeError(
+            f'The {stage} stage failed for "{manifest_filename}":\n'
+            f'{bytes.decode(process.stderr or b"")}')
+    return json.loads(process.stdout)
+
+
+def _describe_build():
+    def output(*args):
+        try:
+            return subprocess.run(
+                args, capture_output=True, text=True,
+                cwd=os.path.dirname(MERGER_FILENAME)).stdout.strip()
+        except OSError:
+            return None
+
+    return {
+        'commit': output('git', 'rev-parse', 'HEAD'),
+        'dirty': bool(output('git', 'status', '--porcelain', '--',
+                             os.path.basename(MERGER_FILENAME))),
+        'ffmpeg': (output('ffmpeg', '-version') or '').split('\n')[0],
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def run_benchmarks(args):
+    results = []
+    for shape_name in args.shapes:
+        print(f'Generating {shape_name}', file=sys.stderr)
+        manifest_filename = generate_book(args.work_dir, shape_name, args.scale)
+        state_fd, state_filename = tempfile.mkstemp(
+            dir=os.path.dirname(manifest_filename), suffix='.tmp.json')
+        os.close(state_fd)
+        try:
+            for repeat in range(args.repeat):
+                for stage in STAGES:
+                    print(f'Running {shape_name} {stage} '
+                          f'({repeat + 1}/{args.repeat})', file=sys.stderr)
+                    result = _run_stage_process(
+                        stage, manifest_filename, state_filename, args.verbose)
+                    results.append({
+                        'shape': shape_name,
+                        'stage': stage,
+                        'repeat': repeat,
+                        **result,
+                    })
+        finally:
+            os.remove(state_filename)
+    return results
+
+
+# Writes a manifest of the given format with every file in a chapter of its
+# own, which is the most chapters there can be to look up. The files don't
+# need to exist to be parsed.
+def generate_manifest(work_dir, format, files):
+    manifest_filename = os.path.join(
+        work_dir, 'manifests', f'{files}.{format}')
+    if os.path.isfile(manifest_filename):
+        return manifest_filename
+
+    os.makedirs(os.path.dirname(manifest_filename), exist_ok=True)
+    with open(manifest_filename + '.tmp', 'w', encoding='utf-8') as manifest:
+        if format == 'txt':
+            manifest.write('[metadata]\ntitle = Benchmark\n')
+        for index in range(files):
+            if format == 'csv':
+                manifest.write(f'{index:06}.mp3,Chapter {index + 1}\n')
+            else:
+                manifest.write(f'[chapter: Chapter {index + 1}]\n'
+                               f'{index:06}.mp3\n')
+    os.replace(manifest_filename + '.tmp', manifest_filename)
+    return manifest_filename
+
+
+# Times parsing each manifest, keeping the best of --repeat runs. Parsing is
+# linear if the time per file stays the same as the manifests get bigger.
+def run_parser_benchmarks(args):
+    merger = load_merger()
+    results = []
+    for format in MANIFEST_FORMATS:
+        for files in args.parser_files:
+            print(f'Parsing {files} files from {format}', file=sys.stderr)
+            manifest_filename = generate_manifest(args.work_dir, format, files)
+            best = None
+            for _ in range(args.repeat):
+                start_time = time.perf_counter()
+                manifest = merger.read_manifests([manifest_filename])
+                wall = time.perf_counter() - start_time
+                best = wall if best is None else min(best, wall)
+            if len(manifest.chapters) != files:
+                raise RuntimeError(
+                    f'Expected {files} chapters in "{manifest_filename}"')
+            results.append({
+                'format': format,
+                'files': files,
+                'wall_seconds': best,
+                'microseconds_per_file': best * 1000000 / files,
+            })
+    return results
+
+
+def print_parser_summary(results):
+    print(f'{"format":<7} {"files":>8} {"wall":>8} {"us/file":>8}',
+          file=sys.stderr)
+    for r in results:
+        print(f'{r["format"]:<7} {r["files"]:>8} {r["wall_seconds"]:>7.3f}s '
+              f'{r["microseconds_per_file"]:>8.2f}', file=sys.stderr)
+
+
+def print_summary(results):
+    print(f'{"shape":<18} {"stage":<7} {"wall":>8} {"cpu":>8} '
+          f'{"rss MiB":>8} {"x realtime":>10}', file=sys.stderr)
+    for r in results:
+        cpu = r['cpu_seconds'] + r['children_cpu_seconds']
+        rss = max(r['peak_rss_bytes'], r['children_peak_rss_bytes'])
+        speed = r['audio_seconds'] / max(r['wall_seconds'], 1e-6)
+        print(f'{r["shape"]:<18} {r["stage"]:<7} {r["wall_seconds"]:>7.2f}s '
+              f'{cpu:>7.2f}s {rss / (1024 * 1024):>8.1f} {speed:>10.1f}',
+              file=sys.stderr)
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(
+        description='Benchmark audiobook-merger.py on synthetic audiobooks.')
+    parser.add_argument('-o', '--output', type=str, default='benchmark.json',
+                        help="Where to write the results as JSON.")
+    parser.add_argument('--shapes', nargs='+', choices=sorted(SHAPES),
+                        default=sorted(SHAPES),
+                        help="The kinds of book to benchmark.")
+    parser.add_argument('--scale', type=float, default=1,
+                        help="Scales the length of every file, for quicker "
+                             "or longer runs.")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="How many times to run each stage.")
+    parser.add_argument('--work-dir', type=str,
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'audiobook-merger-benchmark'),
+                        help="Where to keep the generated books.")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="Show the progress of each stage.")
+    parser.add_argument('--parser', action='store_true',
+                        help="Time parsing manifests instead of merging "
+                             "books.")
+    parser.add_argument('--parser-files', type=int, nargs='+',
+                        default=PARSER_FILES,
+                        help="The sizes of the manifests to parse with "
+                             "--parser, in files.")
+    # used internally to run a single stage in its own process
+    parser.add_argument('--stage', choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument('stage_args', nargs='*', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.scale <= 0:
+        raise RuntimeError('Expected --scale to be more than 0')
+    if args.repeat < 1:
+        raise RuntimeError('Expected --repeat to be at least 1')
+    if any(files < 1 for files in args.parser_files):
+        raise RuntimeError('Expected --parser-files to be at least 1')
+    args.work_dir = os.path.abspath(args.work_dir)
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_command_line()
+
+    if args.stage:
+        json.dump(run_stage(args.stage, *args.stage_args), sys.stdout)
+        sys.exit(0)
+
+    if args.parser:
+        results = run_parser_benchmarks(args)
+        print_parser_summary(results)
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump({
+                'build': _describe_build(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'parser': results,
+            }, output_file, indent=2)
+        sys.exit(0)
+
+    results = run_benchmarks(args)
+    print_summary(results)
+    with open(args.output, 'w', encoding='utf-8') as output_file:
+        json.dump({
+            'build': _describe_build(),
+            'scale': args.scale,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'shapes': {name: SHAPES[name] for name in args.shapes},
+            'results': results,
+        }, output_file, indent=2)
@@ -1,6 +1,5 @@
 #!/bin/bash
 
-while read -r file ; do
-    sha256sum "$file"
-done < <(find "$1" -type f | sort)
-
+# hashes every file under a directory, in sha256sum's format, several at a
+# time and skipping the ones that haven't changed since the last run
+exec python3 "$(dirname "$0")/audiobook-merger.py" --checksum "$1"
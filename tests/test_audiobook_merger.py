@@ -0,0 +1,339 @@
+import argparse
+import importlib.util
+import os
+import sys
+from pathlib import Path
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+# the script's name has a hyphen in it, so it's loaded from its path
+_spec = importlib.util.spec_from_file_location(
+    'audiobook_merger',
+    Path(__file__).resolve().parent.parent / 'audiobook-merger.py')
+merger = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(merger)
+
+
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb'):
+        pass
+
+
+class DirectoryScannerTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = self._dir.name
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def scan(self, titles):
+        # the titles come from the files' tags, by file name
+        def probe_file(file_name, cache=None):
+            title = titles.get(os.path.basename(file_name))
+            return merger.AudioFileInfo(
+                file_name, 1, tags={'title': title} if title else {})
+
+        manifest = merger.Manifest()
+        with mock.patch.object(merger, 'probe_file', probe_file):
+            merger.DirectoryScanner(self.path, manifest, jobs=2)
+        return [(chapter.name, [os.path.basename(f) for f in chapter.files])
+                for chapter in manifest.chapters]
+
+    def test_adjacent_files_with_the_same_title_are_one_chapter(self):
+        for name in ('01.mp3', '02.mp3', '03.mp3'):
+            _touch(os.path.join(self.path, name))
+        chapters = self.scan({'01.mp3': 'A', '02.mp3': 'A', '03.mp3': 'B'})
+        self.assertEqual(chapters, [
+            ('A', ['01.mp3', '02.mp3']),
+            ('B', ['03.mp3']),
+        ])
+
+    def test_repeated_titles_keep_the_files_in_order(self):
+        for name in ('01.mp3', '02.mp3', '03.mp3'):
+            _touch(os.path.join(self.path, name))
+        chapters = self.scan({'01.mp3': 'A', '02.mp3': 'B', '03.mp3': 'A'})
+        self.assertEqual(chapters, [
+            ('A', ['01.mp3']),
+            ('B', ['02.mp3']),
+            ('A', ['03.mp3']),
+        ])
+
+    def test_subdirectories_are_chapters_after_the_files(self):
+        _touch(os.path.join(self.path, '01.mp3'))
+        _touch(os.path.join(self.path, 'Part 2', '01.mp3'))
+        _touch(os.path.join(self.path, 'Part 10', '01.mp3'))
+        chapters = self.scan({})
+        self.assertEqual(chapters, [
+            ('01', ['01.mp3']),
+            ('Part 2', ['01.mp3']),
+            ('Part 10', ['01.mp3']),
+        ])
+
+    def test_subdirectories_without_audio_are_skipped(self):
+        _touch(os.path.join(self.path, 'Artwork', 'cover.jpg'))
+        _touch(os.path.join(self.path, 'Part 1', '01.mp3'))
+        _touch(os.path.join(self.path, 'Scans', 'Empty', 'notes.txt'))
+        chapters = self.scan({})
+        self.assertEqual(chapters, [('Part 1', ['01.mp3'])])
+
+
+class MergeBatchTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = self._dir.name
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_output_dir_is_created(self):
+        inbox = os.path.join(self.path, 'inbox')
+        output_dir = os.path.join(self.path, 'out', 'books')
+        os.makedirs(inbox)
+        with open(os.path.join(inbox, 'book.csv'), 'w') as manifest_file:
+            manifest_file.write('01.mp3,Chapter 1\n')
+        args = argparse.Namespace(
+            input_filenames=[inbox], output_dir=output_dir, root_dir=None,
+            jobs=1, max_processes=1, max_memory=1024 * 1024, engine='pipe',
+            prefetch=0, buffer_size=1024 * 1024)
+
+        # stands in for the merge, which needs the output's directory
+        def merge_audiobook(args, manifest, input_filenames, output_filename,
+                            cache=None):
+            with open(output_filename, 'wb'):
+                pass
+
+        with mock.patch.object(merger, 'merge_audiobook', merge_audiobook), \
+                mock.patch.object(merger.tqdm, 'write'):
+            books = merger.merge_batch(args)
+
+        self.assertEqual([book['status'] for book in books], ['ok'])
+        self.assertTrue(
+            os.path.isfile(os.path.join(output_dir, 'book.m4b')))
+
+
+class UpdateChapterMarksTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = self._dir.name
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_update_keeps_stream_copied_chapter_marks(self):
+        output_filename = os.path.join(self.path, 'book.m4b')
+        with open(output_filename, 'wb'):
+            pass
+        manifest = merger.Manifest()
+        for chapter_name, file_name in (('One', 'a1.m4a'), ('One', 'a2.m4a'),
+                                        ('Two', 'a3.m4a')):
+            manifest.add_file(chapter_name, file_name)
+
+        # AAC files that can be stream copied, whose packets (with the
+        # encoder delay and padding) last longer than the decoded audio
+        def get_chapter_metadata(input_chapters, jobs=None, cache=None):
+            return [{
+                'name': chapter.name,
+                'files': [merger.AudioFileInfo(
+                    file_name, 2.5, codec='aac', profile='LC',
+                    sample_rate=44100, channels=2, frames=110)
+                    for file_name in chapter.files],
+            } for chapter in input_chapters]
+
+        updates = []
+
+        def update_mp4_in_place(file_name, metadata, chapter_marks,
+                                album_art_filename):
+            updates.append(chapter_marks)
+            return True
+
+        argv = ['audiobook-merger.py', os.path.join(self.path, 'book.csv'),
+                '-o', output_filename, '-u', '--no-cache']
+        with mock.patch.object(sys, 'argv', argv):
+            args = merger.parse_command_line()
+        with mock.patch.object(merger, 'get_chapter_metadata',
+                               get_chapter_metadata), \
+                mock.patch.object(merger, 'update_mp4_in_place',
+                                  update_mp4_in_place):
+            merger.merge_audiobook(
+                args, manifest, args.input_filenames, output_filename)
+
+        chapters = get_chapter_metadata(manifest.chapters)
+        self.assertEqual(updates, [list(merger.chapter_marks(
+            chapters, merger.stream_copy_duration))])
+        self.assertNotEqual(updates[0], list(merger.chapter_marks(chapters)))
+
+
+def _full_box(type, *fields, size=0):
+    # a version 0 box of 32 bit fields, padded out to size
+    payload = struct.pack(f'>I{len(fields)}I', 0, *fields)
+    return merger.Mp4Box(type, payload=payload.ljust(size, b'\0'))
+
+
+def _trak(track_id, handler, *children):
+    return merger.Mp4Box(b'trak', children=[
+        _full_box(b'tkhd', 0, 0, track_id, 0, 0, size=84),
+        *children,
+        merger.Mp4Box(b'mdia', children=[
+            _full_box(b'mdhd', 0, 0, 1000, 0, 0),
+            merger.Mp4Box(b'hdlr', payload=b'\0' * 8 + handler + b'\0' * 13),
+            merger.Mp4Box(b'minf', children=[
+                merger.Mp4Box(b'stbl', children=[
+                    _full_box(b'stts', 0),
+                    _full_box(b'stsc', 0),
+                    _full_box(b'stsz', 0, 0),
+                    _full_box(b'stco', 0),
+                ]),
+            ]),
+        ]),
+    ])
+
+
+class UpdateMp4InPlaceTest(unittest.TestCase):
+    AUDIO = b'\xff' * 4096
+    CHAPTERS = [(0, 1000, 'One'), (1000, 2000, 'Two')]
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self._dir.name, 'book.m4b')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    # writes a file with an audio track and a chapter text track, and its
+    # moov box before the audio (with some free space after it) or after
+    def make_mp4(self, moov_at_end, padding=0):
+        moov = merger.Mp4Box(b'moov', children=[
+            _full_box(b'mvhd', 0, 0, 1000, 0, size=100),
+            _trak(1, b'soun', merger.Mp4Box(b'tref', children=[
+                merger.Mp4Box(b'chap', payload=struct.pack('>I', 2))])),
+            _trak(2, b'text'),
+        ]).to_bytes()
+        ftyp = merger.Mp4Box(b'ftyp', payload=b'M4A \0\0\0\0').to_bytes()
+        mdat = merger.Mp4Box(b'mdat', payload=self.AUDIO).to_bytes()
+        free = merger.Mp4Box(b'free', payload=b'\0' * (padding - 8)).to_bytes() \
+            if padding else b''
+        with open(self.file_name, 'wb') as mp4_file:
+            mp4_file.write(ftyp + mdat + moov if moov_at_end
+                           else ftyp + moov + free + mdat)
+
+    def update(self, title):
+        # note how many moov boxes the file has whenever it's synced
+        syncs = []
+        fsync = os.fsync
+
+        def sync(fd):
+            fsync(fd)
+            syncs.append([box.type for _, box in self.boxes()].count(b'moov'))
+
+        with mock.patch.object(merger.os, 'fsync', sync):
+            self.assertTrue(merger.update_mp4_in_place(
+                self.file_name, {'title': title}, self.CHAPTERS, None))
+        return syncs
+
+    def boxes(self):
+        with open(self.file_name, 'rb') as mp4_file:
+            self.data = mp4_file.read()
+        offset = 0
+        boxes = []
+        for box in merger.Mp4Box.parse_all(self.data):
+            boxes.append((offset, box))
+            offset += len(box.to_bytes())
+        return boxes
+
+    def layout(self):
+        return [box.type for _, box in self.boxes()]
+
+    def offset_of(self, type):
+        return next(offset for offset, box in self.boxes() if box.type == type)
+
+    def check(self, title):
+        boxes = self.boxes()
+        moov, = [box for _, box in boxes if box.type == b'moov']
+        ilst = moov.find(b'udta', b'meta', b'ilst')
+        data, = merger.Mp4Box.parse_all(ilst.find(b'\xa9nam').payload)
+        self.assertEqual(data.payload[8:], title.encode())
+
+        # the audio is where it was, and the chapter titles where they're
+        # said to be
+        audio = [(offset, box) for offset, box in boxes
+                 if box.type == b'mdat' and box.payload == self.AUDIO]
+        self.assertEqual(len(audio), 1)
+        offset, size = merger._mp4_chapter_data(moov.find_all(b'trak')[1])
+        samples = self.data[offset:offset + size]
+        titles = []
+        while samples:
+            length, = struct.unpack_from('>H', samples)
+            titles.append(samples[2:2 + length].decode())
+            samples = samples[2 + length + len(merger.MP4_TEXT_ENCODING_BOX):]
+        self.assertEqual(titles, [name for _, _, name in self.CHAPTERS])
+        self.assertIsNotNone(moov.find(b'udta', b'chpl'))
+
+    def test_moov_at_start_grows_into_free_space(self):
+        self.make_mp4(False, padding=4096)
+        size = os.path.getsize(self.file_name)
+        audio_offset = self.offset_of(b'mdat')
+        self.update('A' * 1000)
+        self.check('A' * 1000)
+        self.assertEqual(os.path.getsize(self.file_name), size)
+        self.assertEqual(self.layout(),
+                         [b'ftyp', b'mdat', b'moov', b'free', b'mdat'])
+        self.assertEqual(self.boxes()[4][0], audio_offset)
+
+    def test_moov_at_start_shrinks_in_place(self):
+        self.make_mp4(False, padding=4096)
+        self.update('A' * 1000)
+        size = os.path.getsize(self.file_name)
+        moov_offset = self.offset_of(b'moov')
+        self.update('B')
+        self.check('B')
+        self.assertEqual(os.path.getsize(self.file_name), size)
+        self.assertEqual(self.offset_of(b'moov'), moov_offset)
+        self.assertEqual(self.layout(),
+                         [b'ftyp', b'mdat', b'moov', b'free', b'mdat'])
+
+    def test_moov_at_start_without_room_is_appended(self):
+        self.make_mp4(False)
+        syncs = self.update('A' * 1000)
+        self.check('A' * 1000)
+        self.assertEqual(self.layout(),
+                         [b'ftyp', b'free', b'mdat', b'mdat', b'moov'])
+        # the new moov was on disk before the old one was freed
+        self.assertEqual(syncs, [2, 1])
+
+    def test_moov_at_end_is_appended_before_the_old_one_is_freed(self):
+        self.make_mp4(True)
+        size = os.path.getsize(self.file_name)
+        syncs = self.update('B')
+        self.check('B')
+        self.assertGreater(os.path.getsize(self.file_name), size)
+        self.assertEqual(self.layout(),
+                         [b'ftyp', b'mdat', b'free', b'mdat', b'moov'])
+        self.assertEqual(syncs, [2, 1])
+
+    def test_moov_at_end_reuses_the_space_freed_before(self):
+        self.make_mp4(True)
+        self.update('B')
+        self.update('A' * 1000)
+        size = os.path.getsize(self.file_name)
+
+        # a smaller moov fits in the space the ones before took, and the
+        # one after it is cut off once it's no longer needed
+        syncs = self.update('B')
+        self.check('B')
+        self.assertLess(os.path.getsize(self.file_name), size)
+        self.assertEqual(self.layout(),
+                         [b'ftyp', b'mdat', b'mdat', b'moov', b'free'])
+        self.assertEqual(syncs, [2, 1])
+
+        # and a bigger one is appended again
+        self.update('C' * 2000)
+        self.check('C' * 2000)
+        self.assertEqual(self.layout(),
+                         [b'ftyp', b'mdat', b'free', b'mdat', b'moov'])
+
+if __name__ == '__main__':
+    unittest.main()